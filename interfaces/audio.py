@@ -7,7 +7,15 @@ import scipy.io.wavfile as wavfile
 import scipy.signal
 #
 import numpy as np
+import collections
+import fractions
+import glob
+import hashlib
 import os
+import shutil
+import struct
+import sys
+import tempfile
 
 def wavread(file_name):
     '''
@@ -36,23 +44,31 @@ def rawread(file_name, byteorder_raw='littleendian'):
     
 def rawwrite(file_name, x):
     '''
-    Write audio signal in raw format
+    Write audio signal in raw format, see audiowriter for block-wise writing
     '''
     # Adjust bundaries to max in int16
     max_array_value = np.max(np.absolute(x))
     max_int16       = np.iinfo(np.int16).max
-    x               = np.ceil(x * (0.99 * max_int16/max_array_value))
-    x               = np.cast['int16'](x)
-    x.tofile(open(file_name, 'wb'), format='%h')
+    with audiowriter(file_name, gain=0.99*max_int16/max_array_value) as fid:
+        fid.write(x)
     
     return 1
 
-def read(file_name, in_fs=None, out_fs=None, byteorder_raw='littleendian'):
+def read(file_name, in_fs=None, out_fs=None, byteorder_raw='littleendian',
+         cache=None):
     '''
     Tries to pick appropiate method based on file type, ensures fs correct
-    and donwsamples to appropiate working frequency if solicited.
+    and resamples to appropiate working frequency if solicited, see
+    resample().
+
+    If an audiocache is given, decoded signals are taken from it when
+    possible, see audiocache.read()
     '''
 
+    if cache is not None:
+        return cache.read(file_name, in_fs=in_fs, out_fs=out_fs,
+                          byteorder_raw=byteorder_raw)
+
     # Check files exist
     if not os.path.exists(file_name):
         raise IOError, "Can not open file_name %s" % file_name
@@ -82,11 +98,723 @@ def read(file_name, in_fs=None, out_fs=None, byteorder_raw='littleendian'):
     # Resample to work_fs if solicited
     if not out_fs:
         out_fs = in_fs    
-    else:
-        if out_fs < in_fs:
-            y = scipy.signal.decimate(y, in_fs/out_fs)
-        elif out_fs > in_fs:
-            raise ValueError, ("Your work sampling frequency is in fact larger"
-                              " than the fs of the file!")
+    elif out_fs != in_fs:
+        y = resample(y, in_fs, out_fs)
     
     return [y, out_fs]
+
+# Sample types of WAV files as (format tag, bits per sample)
+WAV_DTYPES = {(1, 8): 'u1', (1, 16): 'i2', (1, 32): 'i4', (3, 32): 'f4',
+              (3, 64): 'f8'}
+
+def wavheader(file_name):
+    '''
+    Parses the header of a WAV file without reading the samples
+
+    Input: file_name  string, path to the file, or an open file object (e.g.
+                      a pipe) positioned at the start of the header. In the
+                      latter case it is left at the first sample
+
+    Output: [fs, nchannels, dtype, offset, nsamples] where dtype is the numpy
+            type of the samples as stored and offset the position of the 
+            first sample in bytes
+    '''
+    if isinstance(file_name, str):
+        with open(file_name, 'rb') as fid:
+            header = wavheader(fid)
+        # Size in header may be wrong for unfinished files, trust file size
+        size      = os.path.getsize(file_name) - header[3]
+        header[4] = min(header[4], size/(header[2].itemsize*header[1]))
+        return header
+
+    # Only forward reads, so that pipes work too
+    fid  = file_name
+    riff = fid.read(12)
+    # Little endian RIFF or big endian RIFX
+    if len(riff) < 12 or riff[8:12] != 'WAVE' or riff[:4] not in ['RIFF', 'RIFX']:
+        raise IOError, "%s is not a WAV file" % fid.name
+    endian = '<' if riff[:4] == 'RIFF' else '>'
+    offset = 12
+    fmt    = None
+    while True:
+        chunk = fid.read(8)
+        if len(chunk) < 8:
+            raise IOError, "No data chunk found in %s" % fid.name
+        chunk_id, size = chunk[:4], struct.unpack(endian + 'I', chunk[4:])[0]
+        offset        += 8
+        if chunk_id == 'data':
+            break
+        # Chunks are padded to even sizes
+        data    = fid.read(size + size % 2)
+        offset += size + size % 2
+        if chunk_id == 'fmt ':
+            fmt = data
+    if fmt is None:
+        raise IOError, "Data before fmt chunk in %s" % fid.name
+
+    [tag, nchannels, fs, _, _, bits] = struct.unpack(endian + 'HHIIHH', fmt[:16])
+    # WAVE_FORMAT_EXTENSIBLE, the tag is in the subformat 
+    if tag == 0xFFFE:
+        tag = struct.unpack(endian + 'H', fmt[24:26])[0]
+    if (tag, bits) not in WAV_DTYPES:
+        raise NotImplementedError, ("WAV format %d with %d bits not supported"
+                                    % (tag, bits))
+    dtype    = np.dtype(WAV_DTYPES[(tag, bits)]).newbyteorder(endian)
+    nsamples = size/(dtype.itemsize*nchannels)
+
+    return [fs, nchannels, dtype, offset, nsamples]
+
+class audiomap():
+    '''
+    Lazy access to the samples of a WAV or RAW/PCM file. The file is memory
+    mapped and only the requested span is converted to float, e.g.
+
+        x = audiomap('session.wav')
+        y = x[48000:96000]          # Samples 
+        y = x.seconds(1.0, 2.0)     # Same in seconds
+
+    Samples keep the scale of the file, as with read(). Multichannel files
+    give [samples, channel] arrays.
+
+    Input: file_name      string, path to a .wav, .raw or .pcm file 
+    Input: in_fs          int, sampling frequency, needed for RAW/PCM 
+    Input: byteorder_raw  'littleendian' or 'bigendian', for RAW/PCM
+    Input: dtype          float type of the output samples
+    '''
+
+    def __init__(self, file_name, in_fs=None, byteorder_raw='littleendian',
+                 dtype=float):
+
+        if not os.path.exists(file_name):
+            raise IOError, "Can not open file_name %s" % file_name
+
+        audio_type = os.path.basename(file_name).split('.')[-1]
+        if audio_type == 'raw' or audio_type == 'pcm':
+            # Enforce providing frequency
+            if not in_fs:
+                raise ValueError, ("For raw/pcm files you need to specify the"
+                                   " input frequency")
+            if byteorder_raw == 'littleendian':
+                raw_dtype = np.dtype('<h')
+            elif byteorder_raw == 'bigendian':     
+                raw_dtype = np.dtype('>h')
+            else:
+                raise ValueError, "Unknown byteorder_raw %s" % byteorder_raw  
+            [fs, nchannels, raw_dtype, offset, 
+             nsamples] = [in_fs, 1, raw_dtype, 0, 
+                          os.path.getsize(file_name)/raw_dtype.itemsize]
+
+        elif audio_type == 'wav':
+            [fs, nchannels, raw_dtype, offset, 
+             nsamples] = wavheader(file_name)
+            # If frequency indicated, check it matches
+            if in_fs and fs != in_fs:
+                raise ValueError, ("You specified a sampling freq. with -fs %d, "
+                                   " but the file has fs %d") % (in_fs, fs)
+        else:
+            raise IOError, "Unknown file type %s" % audio_type
+
+        self.file_name = file_name
+        self.fs        = fs
+        self.nchannels = nchannels
+        self.dtype     = dtype
+        if nchannels == 1:
+            shape = (nsamples,)
+        else:
+            shape = (nsamples, nchannels)
+        # Empty files can not be mapped 
+        if nsamples:
+            self.data = np.memmap(file_name, raw_dtype, mode='r', 
+                                  offset=offset, shape=shape)
+        else:
+            self.data = np.zeros(shape, raw_dtype)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, idx):
+        '''
+        Samples of the given index or slice, converted to float
+        '''
+        return np.asarray(self.data[idx], dtype=self.dtype)
+
+    def seconds(self, start, end=None):
+        '''
+        Samples between start and end seconds (default until the end)
+        '''
+        if end is None:
+            return self[int(round(start*self.fs)):]
+        return self[int(round(start*self.fs)):int(round(end*self.fs))]
+
+def blocks(file_name, blocksize, overlap=0, in_fs=None, out_fs=None, 
+           byteorder_raw='littleendian', audio_type=None, dtype=float):
+    '''
+    Generator of consecutive blocks of samples of a WAV or RAW/PCM file, so
+    that long recordings can be processed without loading them, e.g. 
+
+        for x in blocks('session.wav', 16000, overlap=windowsize-shift):
+            ...
+
+    Only one block is held in memory at a time. 
+
+    Input: file_name      string, path to the file, '-' for stdin or an open
+                          file object (e.g. a pipe)
+    Input: blocksize      int, samples per block (after decimation). The last
+                          block can be shorter
+    Input: overlap        int, samples shared by consecutive blocks
+    Input: in_fs          int, sampling frequency, needed for RAW/PCM
+    Input: out_fs         int, if given the signal is resampled to it, with
+                          the filter state carried across blocks. Results
+                          are the same as with read()
+    Input: byteorder_raw  'littleendian' or 'bigendian', for RAW/PCM
+    Input: audio_type     'wav', 'raw' or 'pcm', by default the file
+                          extension. Needed for stdin and file objects
+    Input: dtype          float type of the output samples
+
+    Output: x             [samples] or [samples, channel] blocks 
+    '''
+
+    # SANITY CHECK: Blocks advance
+    hop = blocksize - overlap
+    if hop <= 0:
+        raise ValueError, "overlap has to be smaller than blocksize"
+
+    # Open input
+    is_path = isinstance(file_name, str) and file_name != '-'
+    if is_path:
+        if not os.path.exists(file_name):
+            raise IOError, "Can not open file_name %s" % file_name
+        if audio_type is None:
+            audio_type = os.path.basename(file_name).split('.')[-1]
+        fid = open(file_name, 'rb')
+    else:
+        if audio_type is None:
+            raise ValueError, "You need to specify audio_type to read streams"
+        fid = sys.stdin if file_name == '-' else file_name
+
+    try:
+
+        # Read header
+        if audio_type == 'raw' or audio_type == 'pcm':
+            # Enforce providing frequency
+            if not in_fs:
+                raise ValueError, ("For raw/pcm files you need to specify the"
+                                   " input frequency")
+            if byteorder_raw == 'littleendian':
+                raw_dtype = np.dtype('<h')
+            elif byteorder_raw == 'bigendian':     
+                raw_dtype = np.dtype('>h')
+            else:
+                raise ValueError, "Unknown byteorder_raw %s" % byteorder_raw  
+            nchannels = 1
+            # Read until end of file
+            nsamples  = None
+        elif audio_type == 'wav':
+            [fs, nchannels, raw_dtype, offset, nsamples] = wavheader(fid)
+            # If frequency indicated, check it matches
+            if in_fs and fs != in_fs:
+                raise ValueError, ("You specified a sampling freq. with -fs %d, "
+                                   " but the file has fs %d") % (in_fs, fs)
+            in_fs = fs
+            # Size in header is not reliable for streamed WAVs, read until
+            # end of file
+            if not is_path:
+                nsamples = None
+        else:
+            raise IOError, "Unknown file type %s" % audio_type
+
+        # Resampling
+        if out_fs and out_fs != in_fs:
+            rs = resampler(in_fs, out_fs)
+            # Input samples read per hop
+            q  = int(np.ceil(float(in_fs)/out_fs))
+        else:
+            rs = None
+            q  = 1
+
+        frame_bytes = raw_dtype.itemsize*nchannels
+        buf         = np.zeros((0,) + (nchannels,)*(nchannels > 1), dtype)
+        sent        = False
+        while True:
+            # Read the input samples needed for the next hop
+            n = hop*q
+            if nsamples is not None:
+                n = min(n, nsamples)
+            data = fid.read(n*frame_bytes)
+            x    = np.frombuffer(data[:len(data) - len(data) % frame_bytes],
+                                 raw_dtype)
+            if nchannels > 1:
+                x = x.reshape(-1, nchannels)
+            if nsamples is not None:
+                nsamples -= x.shape[0]
+            # End of file
+            eof = x.shape[0] < n or nsamples == 0
+            if rs is None:
+                y = x
+            elif eof:
+                y = np.concatenate((rs.update(x), rs.flush()))
+            else:
+                y = rs.update(x)
+            buf = np.concatenate((buf, y.astype(dtype)))
+            while buf.shape[0] >= blocksize:
+                yield buf[:blocksize]
+                buf  = buf[hop:]
+                sent = True
+            if eof:
+                break
+
+        # Remaining samples not yielded yet
+        if buf.shape[0] > (overlap if sent else 0):
+            yield buf
+
+    finally:
+        if is_path:
+            fid.close()
+
+
+# Polyphase filters designed so far, by (up, down) ratio
+RESAMPLE_FILTERS = {}
+
+def resample_filter(up, down):
+    '''
+    Anti-aliasing FIR filter for polyphase resampling by up/down, same
+    design as scipy.signal.resample_poly. Designs are cached.
+
+    Output: [h, delay] filter, zero padded in front so that delay, the
+            number of output samples to discard, is an integer
+    '''
+    # Same rate, identity filter
+    if up == down:
+        return [np.ones(1), 0]
+    if (up, down) not in RESAMPLE_FILTERS:
+        half_len = 10*max(up, down)
+        h        = up*scipy.signal.firwin(2*half_len + 1, 1./max(up, down),
+                                          window=('kaiser', 5.0))
+        # Zero-pad the filter to put the output samples at the center
+        n_pre_pad = down - half_len % down
+        h         = np.concatenate((np.zeros(n_pre_pad), h))
+        RESAMPLE_FILTERS[(up, down)] = [h, (half_len + n_pre_pad)/down]
+    return RESAMPLE_FILTERS[(up, down)]
+
+class resampler():
+    '''
+    Streaming polyphase resampling from in_fs to out_fs, any rational ratio.
+    Feed consecutive blocks of samples to update() and call flush() at the
+    end. The concatenated output is the same as resample() on the whole
+    signal. Multichannel signals are given as [samples, channel]. If in_fs
+    and out_fs are the same, blocks are passed through.
+    '''
+
+    def __init__(self, in_fs, out_fs):
+        g            = fractions.gcd(int(in_fs), int(out_fs))
+        self.up      = int(out_fs)/g
+        self.down    = int(in_fs)/g
+        [self.h, 
+         self.delay] = resample_filter(self.up, self.down)
+        # Input samples received, index of the first buffered one, next
+        # output to compute (of the full convolution)
+        self.n   = 0
+        self.s   = 0
+        self.j   = self.delay
+        self.buf = None
+
+    def filter(self, j_end):
+        '''
+        Outputs of the full convolution from self.j to j_end (excluded)
+        using the buffered input
+        '''
+        off = self.s*self.up/self.down
+        y   = scipy.signal.upfirdn(self.h, self.buf, self.up, self.down,
+                                   axis=0)[self.j-off:j_end-off]
+        self.j = j_end
+        # Drop input no longer needed, keep buffer start multiple of down
+        # so that outputs stay aligned
+        s_new    = max((self.j*self.down - len(self.h) + 1)/self.up, self.s)
+        s_new   -= s_new % self.down
+        self.buf = self.buf[s_new-self.s:]
+        self.s   = s_new
+        return y
+
+    def update(self, x):
+        '''
+        Resample the next block, returns the output samples that can be
+        computed so far 
+        '''
+        x = np.asarray(x, dtype=float)
+        # Same rate, nothing to filter
+        if self.up == self.down:
+            self.n   += x.shape[0]
+            self.buf  = x[:0]
+            return x
+        if self.buf is None or not self.buf.shape[0]:
+            self.buf = x
+        else:
+            self.buf = np.concatenate((self.buf, x))
+        self.n   += x.shape[0]
+        # Outputs that only depend on the input received
+        j_end     = ((self.n - 1)*self.up)/self.down + 1
+        if self.n == 0 or j_end <= self.j:
+            return self.buf[:0]
+        return self.filter(j_end)
+
+    def flush(self):
+        '''
+        Returns the remaining output samples, signal assumed zero after the
+        last block
+        '''
+        if self.buf is None:
+            return np.zeros(0)
+        if self.up == self.down:
+            return self.buf
+        # Total output length 
+        n_out    = -((-self.n*self.up)//self.down)
+        pad      = np.zeros((len(self.h)/self.up + 1,) + self.buf.shape[1:])
+        self.buf = np.concatenate((self.buf, pad))
+        return self.filter(self.delay + n_out)
+
+def resample(x, in_fs, out_fs):
+    '''
+    Polyphase resampling of x [samples] or [samples, channel] from in_fs to
+    out_fs, any rational ratio. Filters are cached per ratio, see
+    resample_filter()
+    '''
+    # Same rate, as scipy.signal.resample_poly
+    if int(in_fs) == int(out_fs):
+        return np.array(x)
+    rs = resampler(in_fs, out_fs)
+    return np.concatenate((rs.update(x), rs.flush()))
+
+
+# Folder of the on-disk cache of decoded audio, see audiocache
+AUDIO_CACHE = os.path.join(os.path.expanduser('~'), '.obsunc', 'audio')
+
+class audiocache():
+    '''
+    Cache of decoded and resampled signals as returned by read(), e.g.
+
+        cache  = audiocache()
+        [y, fs] = read(file_name, out_fs=16000, cache=cache)
+
+    Two tiers: an in-process LRU holding up to max_bytes of samples and an
+    on-disk store of float32 .npy files, which are memory mapped when read.
+    Entries are keyed by path, size, modification time, in_fs (RAW/PCM 
+    only, WAV files carry their own), out_fs and byte order, so that entries of files that changed are never used and are
+    deleted when found.
+
+    Signals are returned as read-only float32 arrays, copy them before any
+    in-place processing (e.g. signal.preemphasis()).
+
+    Input: max_bytes     int, budget of the in-process LRU
+    Input: cache_folder  string, folder of the on-disk store, AUDIO_CACHE by
+                         default. Set to '' to disable it
+    '''
+
+    def __init__(self, max_bytes=2**28, cache_folder=None):
+        if cache_folder is None:
+            cache_folder = AUDIO_CACHE
+        self.max_bytes    = max_bytes
+        self.cache_folder = cache_folder
+        self.nbytes       = 0
+        # key -> [y, fs], least recently used first
+        self.entries      = collections.OrderedDict()
+
+    def key(self, file_name, in_fs, out_fs, byteorder_raw):
+        '''
+        Cache key of a file, [name, stamp] where name identifies the file
+        and reading options and stamp its current version
+        '''
+        file_name = os.path.abspath(file_name)
+        stat      = os.stat(file_name)
+        # The rate of WAV files is in their header, in_fs is only checked
+        if os.path.basename(file_name).split('.')[-1] == 'wav':
+            in_fs = None
+        name      = hashlib.sha1(repr((file_name, in_fs, out_fs, 
+                                       byteorder_raw))).hexdigest()
+        return [name, '%d_%d' % (stat.st_size, round(stat.st_mtime*1e6))]
+
+    def read(self, file_name, in_fs=None, out_fs=None,
+             byteorder_raw='littleendian'):
+        '''
+        Same as read() but using the cache
+        '''
+        if not os.path.exists(file_name):
+            raise IOError, "Can not open file_name %s" % file_name
+        [name, stamp] = self.key(file_name, in_fs, out_fs, byteorder_raw)
+
+        # Check the header matches what read() would enforce, for both tiers
+        if in_fs and os.path.basename(file_name).split('.')[-1] == 'wav':
+            fs_wav = wavheader(file_name)[0]
+            if fs_wav != in_fs:
+                raise ValueError, ("You specified a sampling freq. with -fs"
+                                   " %d, but the file has fs %d" 
+                                   % (in_fs, fs_wav))
+
+        # IN-PROCESS LRU
+        if (name, stamp) in self.entries:
+            entry = self.entries.pop((name, stamp))
+            self.entries[(name, stamp)] = entry
+            return list(entry)
+
+        # ON-DISK STORE
+        entry = None
+        if self.cache_folder:
+            prefix = os.path.join(self.cache_folder, '%s_%s_' % (name, stamp))
+            for cache_file in glob.glob(os.path.join(self.cache_folder,
+                                                     name + '_*.npy')):
+                if cache_file.startswith(prefix):
+                    try:
+                        entry = [np.load(cache_file, mmap_mode='r'), 
+                                 int(cache_file[len(prefix):-4])]
+                    except (IOError, ValueError):
+                        entry = None
+                else:
+                    # Stale, the file changed since it was cached
+                    try:
+                        os.remove(cache_file)
+                    except OSError:
+                        pass
+
+        # Decode and store
+        if entry is None:
+            [y, fs] = read(file_name, in_fs=in_fs, out_fs=out_fs, 
+                           byteorder_raw=byteorder_raw)
+            y       = y.astype(np.float32)
+            entry   = [y, fs]
+            # Write to disk, failing to do so is not fatal
+            if self.cache_folder:
+                try:
+                    if not os.path.isdir(self.cache_folder):
+                        os.makedirs(self.cache_folder)
+                    cache_file = prefix + '%d.npy' % fs
+                    # Write and move, so that concurrent readers see complete
+                    # files
+                    tmp_file   = '%s.%d.tmp.npy' % (cache_file[:-4], os.getpid())
+                    np.save(tmp_file, y)
+                    os.rename(tmp_file, cache_file)
+                    entry      = [np.load(cache_file, mmap_mode='r'), fs]
+                except (IOError, OSError):
+                    pass
+            entry[0].flags.writeable = False
+
+        # Remove older versions of this file and insert as most recent
+        for old_key in [k for k in self.entries if k[0] == name]:
+            self.nbytes -= self.entries.pop(old_key)[0].nbytes
+        if entry[0].nbytes <= self.max_bytes:
+            self.entries[(name, stamp)] = entry
+            self.nbytes                += entry[0].nbytes
+            # Evict least recently used
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][0].nbytes
+
+        return list(entry)
+
+
+class audiowriter():
+    '''
+    Block-wise writer of int16 RAW/PCM or WAV files, e.g. to stream the
+    output of istft() to disk
+
+        with audiowriter('enhanced.wav', fs=16000, normalize=True) as fid:
+            for x in ...:
+                fid.write(x)
+
+    Float samples are scaled, rounded up and clipped to int16 in a scratch
+    buffer reused across blocks. WAV headers are completed on close().
+
+    Input: file_name      string, path to a .wav, .raw or .pcm file
+    Input: fs             int, sampling frequency, needed for WAV
+    Input: gain           float, samples are multiplied by it
+    Input: normalize      bool, scale so that the maximum is at 0.99 of the
+                          int16 range, as rawwrite(). Needs two passes, the
+                          blocks are kept in a temporary file until close()
+    Input: byteorder_raw  'littleendian' or 'bigendian' (RIFX for WAV)
+    '''
+
+    def __init__(self, file_name, fs=None, gain=1., normalize=False,
+                 byteorder_raw='littleendian'):
+
+        audio_type = os.path.basename(file_name).split('.')[-1]
+        if audio_type not in ['raw', 'pcm', 'wav']:
+            raise IOError, "Unknown file type %s" % audio_type
+        if audio_type == 'wav' and not fs:
+            raise ValueError, "For wav files you need to specify fs"
+        if byteorder_raw == 'littleendian':
+            self.endian = '<'
+        elif byteorder_raw == 'bigendian':     
+            self.endian = '>'
+        else:
+            raise ValueError, "Unknown byteorder_raw %s" % byteorder_raw  
+
+        self.is_wav    = audio_type == 'wav'
+        self.fs        = fs
+        self.gain      = gain
+        self.normalize = normalize
+        self.nchannels = None
+        self.nsamples  = 0
+        self.max_value = 0.
+        # Scratch buffers
+        self.buf       = np.zeros(0)
+        self.ibuf      = np.zeros(0, self.endian + 'h')
+        self.fid       = open(file_name, 'wb')
+        # Header is written on close()
+        if self.is_wav:
+            self.fid.write('\0'*44)
+        # Float samples until the maximum is known
+        if normalize:
+            self.tmp = tempfile.TemporaryFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, x):
+        '''
+        Write a block of samples, [samples] or [samples, channel]
+        '''
+        x         = np.asarray(x)
+        nchannels = 1 if x.ndim == 1 else x.shape[1]
+        if self.nchannels is None:
+            self.nchannels = nchannels
+        elif nchannels != self.nchannels:
+            raise ValueError, ("Block has %d channels, %d expected" 
+                               % (nchannels, self.nchannels))
+        self.nsamples += x.shape[0]
+        if self.normalize:
+            if x.size:
+                self.max_value = max(self.max_value, np.max(np.absolute(x)))
+            np.asarray(x, dtype=float).tofile(self.tmp)
+        else:
+            self.convert(x, self.gain)
+
+    def convert(self, x, gain):
+        '''
+        Scale, round and write a block as int16 
+        '''
+        n = x.size
+        if self.buf.size < n:
+            self.buf  = np.zeros(n)
+            self.ibuf = np.zeros(n, self.endian + 'h')
+        buf  = self.buf[:n].reshape(x.shape)
+        ibuf = self.ibuf[:n].reshape(x.shape)
+        np.multiply(x, gain, out=buf)
+        np.ceil(buf, out=buf)
+        np.clip(buf, -32768, 32767, out=buf)
+        ibuf[...] = buf
+        ibuf.tofile(self.fid)
+
+    def close(self):
+        '''
+        Writes pending samples and the WAV header and closes the file
+        '''
+        if self.fid.closed:
+            return
+        # Second pass, scale to the maximum
+        if self.normalize:
+            gain = self.gain
+            if self.max_value > 0:
+                gain = 0.99*np.iinfo(np.int16).max/self.max_value
+            self.tmp.seek(0)
+            while True:
+                x = np.fromfile(self.tmp, float, 2**16*(self.nchannels or 1))
+                if not x.size:
+                    break
+                if self.nchannels > 1:
+                    x = x.reshape(-1, self.nchannels)
+                self.convert(x, gain)
+            self.tmp.close()
+        if self.is_wav:
+            nchannels  = self.nchannels or 1
+            data_bytes = 2*nchannels*self.nsamples
+            self.fid.seek(0)
+            self.fid.write(struct.pack(self.endian + '4sI4s4sIHHIIHH4sI', 
+                                       'RIFF' if self.endian == '<' else 'RIFX',
+                                       36 + data_bytes, 'WAVE', 'fmt ', 16, 1,
+                                       nchannels, self.fs,
+                                       2*nchannels*self.fs, 2*nchannels, 16,
+                                       'data', data_bytes))
+        self.fid.close()
+
+
+def parity(n=4567, seed=0):
+    '''
+    Checks resample() and resampler(), fed with blocks of random size,
+    against scipy.signal.resample_poly for several rates, including the
+    same rate, on single and multichannel signals
+
+    Input: n     number of samples of the test signals
+    Input: seed  seed of the test signals and block sizes
+    '''
+    rs = np.random.RandomState(seed)
+    for in_fs, out_fs in [(48000, 16000), (44100, 16000), (16000, 48000),
+                          (22050, 16000), (16000, 16000)]:
+        g = fractions.gcd(in_fs, out_fs)
+        for shape in [(n,), (n, 3)]:
+            x   = rs.randn(*shape)
+            ref = scipy.signal.resample_poly(x, out_fs/g, in_fs/g, axis=0)
+            y   = resample(x, in_fs, out_fs)
+            # Streaming in blocks of random size
+            stream = resampler(in_fs, out_fs)
+            blocks = []
+            i      = 0
+            while i < n:
+                size = rs.randint(1, 700)
+                blocks.append(stream.update(x[i:i+size]))
+                i   += size
+            blocks.append(stream.flush())
+            y_s = np.concatenate(blocks)
+            # SANITY CHECK: Same output as scipy
+            assert y.shape == ref.shape and np.allclose(y, ref), \
+                "resample() differs for %d -> %d" % (in_fs, out_fs)
+            assert y_s.shape == ref.shape and np.allclose(y_s, ref), \
+                "resampler() differs for %d -> %d" % (in_fs, out_fs)
+        print "%5d -> %5d resample() and resampler() match" % (in_fs, out_fs)
+
+def cachecheck(n=48000, seed=0):
+    '''
+    Checks that audiocache returns what read() does when the same RAW file
+    is read at two in_fs, from the in-process and the on-disk tier, and 
+    that a WAV rate mismatch is caught on both tiers
+
+    Input: n     number of samples of the test signals
+    Input: seed  seed of the test signals
+    '''
+    folder = tempfile.mkdtemp()
+    try:
+        x        = np.random.RandomState(seed).randn(n)
+        raw_file = os.path.join(folder, 'a.raw')
+        wav_file = os.path.join(folder, 'a.wav')
+        rawwrite(raw_file, x)
+        with audiowriter(wav_file, fs=16000, normalize=True) as fid:
+            fid.write(x)
+        cache_folder = os.path.join(folder, 'cache')
+        for tier, cache in [('memory', audiocache(cache_folder=cache_folder)),
+                            ('disk', audiocache(cache_folder=cache_folder,
+                                                max_bytes=0))]:
+            for in_fs, out_fs in [(48000, 16000), (32000, 16000), 
+                                  (16000, None), (8000, None)]:
+                # Twice, the second time from the cache
+                for r in range(2):
+                    [y, fs]     = read(raw_file, in_fs=in_fs, out_fs=out_fs, 
+                                       cache=cache)
+                [y_ref, fs_ref] = read(raw_file, in_fs=in_fs, out_fs=out_fs)
+                # SANITY CHECK: Same as without cache
+                assert fs == fs_ref and y.shape == y_ref.shape, \
+                    ("%s tier: in_fs %d gives %d samples at %d Hz, expected"
+                     " %d at %d Hz" % (tier, in_fs, len(y), fs, len(y_ref), 
+                                       fs_ref))
+                assert np.allclose(y, y_ref, atol=1e-3*np.abs(y_ref).max())
+            read(wav_file, cache=cache)
+            try:
+                read(wav_file, in_fs=8000, cache=cache)
+                raise AssertionError, "%s tier: WAV rate mismatch missed" % tier
+            except ValueError:
+                pass
+            print "%-6s tier matches read()" % tier
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    parity()
+    cachecheck()
@@ -4,7 +4,13 @@ Interfaces to the DIRHA project data
 
 import re
 import os
+import fractions
+import multiprocessing.pool
+import sys
 import numpy as np
+# Add the path of the toolbox root, it is not installed
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
+import interfaces.audio as au
 
 ##############
 #  CONSTANTS
@@ -279,6 +285,81 @@ def readmetadata(txt_path, in_fs=None, work_fs=None):
     return (events, sources, mics)
 
 
+def select_mics(rooms=None, devices=None, mics=None):
+    '''
+    Subset of MIC_LIST, in its order, for the given rooms, devices and/or
+    microphones, e.g. select_mics(rooms=['Kitchen'], devices=['Array'])
+
+    Input: rooms    list of room names, cropped names as in fix_room_name()
+                    are also admitted
+    Input: devices  list of device names ('Array', 'Wall')
+    Input: mics     list of microphone names e.g. 'KA3'
+    '''
+    if rooms is not None:
+        rooms = [fix_room_name(room) for room in rooms]
+    mic_list = []
+    for mic_path in MIC_LIST:
+        [room, device, mic] = mic_path[:-4].split('/')
+        if rooms is not None and room.upper() not in rooms:
+            continue
+        if devices is not None and device not in devices:
+            continue
+        if mics is not None and mic not in mics:
+            continue
+        mic_list.append(mic_path)
+    if not mic_list:
+        raise ValueError, ("No microphone matches rooms %s, devices %s, mics"
+                           " %s" % (rooms, devices, mics))
+    return mic_list
+
+def readmics(mics_path, rooms=None, devices=None, mics=None, out_fs=None,
+             n_jobs=1):
+    '''
+    Reads all microphones of a DIRHA simulation into a single contiguous
+    [samples, mics] float32 array, e.g. for array processing. Mics are
+    memory mapped, converted and resampled straight into their column.
+
+    Input: mics_path  string, Mixed_Sources folder of the simulation, see
+                      comp_DIRHA_mics_path() 
+    Input: rooms, devices, mics  selection of microphones, see select_mics()
+    Input: out_fs     int, sampling frequency to resample to, e.g. 16000. 
+                      Any rational ratio, see audio.resample()
+    Input: n_jobs     int, number of mics decoded and resampled in parallel
+                      (threads)
+
+    Output: [Y, fs, mic_list] where Y[:, m] is the signal of mic_list[m], 
+            with the scale of audio.read()
+    '''
+    mic_list = select_mics(rooms=rooms, devices=devices, mics=mics)
+    mic_maps = micarray(mics_path, mic_list)
+    if not out_fs:
+        out_fs = mic_maps.fs
+    # Length after resampling, same as audio.resample()
+    g     = fractions.gcd(int(mic_maps.fs), int(out_fs))
+    up    = int(out_fs)/g
+    down  = int(mic_maps.fs)/g
+    n_out = -((-len(mic_maps)*up)//down)
+    Y     = np.empty((n_out, len(mic_list)), dtype=np.float32)
+
+    def decode(m):
+        y = mic_maps.maps[m][:len(mic_maps)]
+        if up != down:
+            y = au.resample(y, mic_maps.fs, out_fs)
+        Y[:, m] = y
+
+    # Most of the work (casting, upfirdn) releases the GIL
+    if n_jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+        try:
+            pool.map(decode, range(len(mic_list)))
+        finally:
+            pool.close()
+    else:
+        for m in range(len(mic_list)):
+            decode(m)
+
+    return [Y, out_fs, mic_list]
+
 def dsmp(T, in_fs, work_fs):
     '''
     Adjusts time measured in samples to match the working sampling 
@@ -290,6 +371,59 @@ def dsmp(T, in_fs, work_fs):
 #  CLASSES 
 ##############
 
+class micarray():
+    '''
+    Lazy [samples, mics] view of the microphones of a DIRHA simulation. Each
+    mic is memory mapped (see audio.audiomap) and only the requested span is
+    read, e.g. 
+
+        Y = micarray(mics_path, select_mics(rooms=['Livingroom']))
+        y = Y[48000:96000]        # [samples, mics] float32
+        y = Y.seconds(1.0, 2.0)   # Same in seconds
+
+    Input: mics_path  string, Mixed_Sources folder of the simulation, see
+                      comp_DIRHA_mics_path() 
+    Input: mic_list   list of mics relative to mics_path, MIC_LIST by default
+    '''
+
+    def __init__(self, mics_path, mic_list=None):
+        if mic_list is None:
+            mic_list = MIC_LIST
+        self.mic_list = mic_list
+        self.maps     = [au.audiomap(os.path.join(mics_path, mic), 
+                                     dtype=np.float32) for mic in mic_list]
+        # Sanity check: synchronous, single channel mics
+        self.fs = self.maps[0].fs
+        for mic, mic_map in zip(mic_list, self.maps):
+            if mic_map.fs != self.fs or mic_map.nchannels != 1:
+                raise ValueError, ("%s has fs %d and %d channels, expected fs"
+                                   " %d and 1 channel" % (mic, mic_map.fs,
+                                   mic_map.nchannels, self.fs))
+        # Unfinished files may be shorter, keep the common span
+        self.nsamples = min([len(mic_map) for mic_map in self.maps])
+
+    def __len__(self):
+        return self.nsamples
+
+    def __getitem__(self, idx):
+        '''
+        [samples, mics] float32 array of the given sample slice, or [mics] for
+        an integer index 
+        '''
+        if isinstance(idx, slice):
+            idx = slice(*idx.indices(self.nsamples))
+        elif idx < 0:
+            idx += self.nsamples
+        return np.stack([mic_map[idx] for mic_map in self.maps], axis=-1)
+
+    def seconds(self, start, end=None):
+        '''
+        Samples between start and end seconds (default until the end)
+        '''
+        if end is None:
+            return self[int(round(start*self.fs)):]
+        return self[int(round(start*self.fs)):int(round(end*self.fs))]
+
 class DirhaMicMetaData():
     '''
     Stores the metadata for one microphone of a DIRHA simulated corpus given
@@ -351,6 +485,13 @@ class DirhaMicMetaData():
         return comp_DIRHA_mics_path(self.path['root'], self.path['lang'], 
                                     self.path['sset'], self.sim)
 
+    def read_mics(self, **kwargs):
+        '''
+        Reads the microphones of this simulation, see readmics()
+        '''
+        return readmics(self.txt_path.split('/Mixed_Sources/')[0] 
+                        + '/Mixed_Sources/', **kwargs)
+
     def get_ref_mic_source(self, src):
         '''
         Returns the reference microphone in the room were this src took 
@@ -5,33 +5,66 @@ Interface functions to HTK formats. For reference see the HTKbook 3.4
 Ramon F. Astudillo
 '''
 
+import binascii
+import collections
+import glob
+import hashlib
+import multiprocessing.pool
 import os
 import re
+import shutil
 import struct
+import tempfile
 import numpy as np
 
+# TYPES AND MODIFIERS ALLOWED IN HTK
+TARGETKIND_TYPES = ['WAVEFORM', 'LPC', 'LPREFC', 'LPCEPSTRA', 'LPDELCEP', 
+                    'IREFC', 'MFCC', 'FBANK', 'MELSPEC', 'USER', 'DISCRETE', 
+                    'PLP', 'ANON']
+TARGETKIND_MODS  = ['E', 'N', 'D', 'A', 'C', 'Z', 'K', '0', 'V', 'T']
+
+# Header of HTK files as stored, see readhtkheaders()
+HTK_HEADER = np.dtype([('nSamples', '>u4'), ('sampPeriod', '>u4'), 
+                       ('sampSize', '>i2'), ('parmKind', '>u2')])
+
+# Parameter kinds stored as 16 bit integers (WAVEFORM, IREFC, DISCRETE) and
+# flags for compressed (_C) and checksummed (_K) data, see targetkind2num()
+SHORT_KINDS = [0, 5, 10]
+HASCOMPX    = 2**10
+HASCRCC     = 2**12
+
 def targetkind2num(targetkind):
     '''
     Computes binary representation of TARGETKIND in HTK
     '''
-    # TYPES AND MODIFIERS ALLOWED IN HTK
-    types = ['WAVEFORM', 'LPC', 'LPREFC', 'LPCEPSTRA', 'LPDELCEP', 'IREFC', 
-             'MFCC', 'FBANK', 'MELSPEC', 'USER', 'DISCRETE', 'PLP', 'ANON']
-    mods  = ['E', 'N', 'D', 'A', 'C', 'Z', 'K', '0', 'V', 'T']
     # TYPE AND MODIFIERS OF THE FEATURE VECTOR
     tokens = targetkind.split('_')
-    if tokens[0] not in types:
+    if tokens[0] not in TARGETKIND_TYPES:
         raise ValueError, "Unknown TARGETKIND type %s" % tokens[0]
     # COMPUTE HTK FORMAT
     # type
-    htk_format = types.index(tokens[0])
+    htk_format = TARGETKIND_TYPES.index(tokens[0])
     # Modifiers
     for mod in tokens[1:]:
-        if mod not in mods:
+        if mod not in TARGETKIND_MODS:
             raise ValueError, "Unknown TARGETKIND modifier %s" % mod
-        htk_format += 2**(6 + mods.index(mod)) 
+        htk_format += 2**(6 + TARGETKIND_MODS.index(mod)) 
     return htk_format 
 
+def num2targetkind(htk_format):
+    '''
+    Inverse of targetkind2num(), e.g. 838 -> 'MFCC_E_D_A'
+    '''
+    if (htk_format & 63) >= len(TARGETKIND_TYPES):
+        raise ValueError, "Unknown TARGETKIND type %d" % (htk_format & 63)
+    if htk_format >> (6 + len(TARGETKIND_MODS)):
+        raise ValueError, "Unknown TARGETKIND modifiers in %d" % htk_format
+    tokens = [TARGETKIND_TYPES[htk_format & 63]]
+    for i, mod in enumerate(TARGETKIND_MODS):
+        if (htk_format >> (6 + i)) & 1:
+            tokens.append(mod)
+    return '_'.join(tokens)
+
 def nextpow2(N):
     '''
     Raise N to the nex power of 2 
@@ -120,7 +153,7 @@ def readhtkconfig(file_path, config, htk_units=False):
 
     return config
 
-def readhtkfeats(htkfeats_file):
+def readhtkfeats(htkfeats_file, frames=None, mmap=False, check_crc=False):
     '''
     Reads a matrix of feature vectors written with the Hidden Markov Model
     Toolbox (HTK) format. Output variable name follows conventions of the
@@ -128,6 +161,25 @@ def readhtkfeats(htkfeats_file):
 
     http://www.ee.ic.ac.uk/hp/staff/dmb/voicebox/voicebox.html
 
+    16 bit kinds (WAVEFORM, IREFC, DISCRETE) and compressed (_C) features
+    are converted to float, IREFC scaled to [-1, 1]. 
+
+    Input: htkfeats_file string   with path to the file to be read
+
+    Input: frames        slice    optional, frames to read e.g. 
+                                  slice(100, 200). Only those are read from
+                                  disk 
+
+    Input: mmap          bool     if True x is a memory mapped, read-only
+                                  view of the file (big-endian float32)
+                                  instead of a float64 copy. Only for 32 bit
+                                  uncompressed data
+
+    Input: check_crc     bool     if True and the file has a checksum (_K),
+                                  verify it. This reads the whole file
+
+    Output: [x, fp, dt, tc] x is [I, L] ndarray of I features and L frames
+
     Ramon F. Astudillo
     '''
 
@@ -135,22 +187,263 @@ def readhtkfeats(htkfeats_file):
     if not os.path.isfile(htkfeats_file):
         raise IOError, "File %s does not exist" % htkfeats_file
 
-    # Open file
-    with open(htkfeats_file, 'r') as fid:
-        # READ HEADER
-        [L, fp, by, tc]  = struct.unpack('>LLhh', fid.read(12))
-        # Convert HTK units to seg
-        fp             = fp*1e-7
-        # DETERMINE DATA TYPE (lower six bits of TC)
-        dt = sum([(2**i)*((tc>>i)&1) for i in xrange(5, -1, -1)])
-        # SANITY CHECK: UNSUPORTED
-        if dt == 0 or dt == 5 or dt == 10:
-            raise NotImplementedError, "Sorry 16bit data not supported"
-        # READ REST
-        x = np.array(struct.unpack('>'+'f'*(by/4)*L, fid.read(by*L)))
-        x = np.reshape(x, (by/4, L), order = 'F')
+    # Map the file, only the pages of the frames read are loaded 
+    if os.path.getsize(htkfeats_file):
+        data = np.memmap(htkfeats_file, 'u1', mode='r')
+    else:
+        data = np.zeros(0, 'u1')
+
+    return readhtkbuffer(data, frames=frames, mmap=mmap, check_crc=check_crc,
+                         name=htkfeats_file)
 
-        return [x, fp, dt, tc]
+
+def readhtkbuffer(data, frames=None, mmap=False, check_crc=False, name=''):
+    '''
+    Same as readhtkfeats() for the content of an HTK file given as a uint8
+    ndarray, e.g. a memory mapped file or a record of an htkarchive. With 
+    mmap=True x is a view of data.
+
+    Input: name  string to identify the data in error messages
+    '''
+
+    # READ HEADER
+    if len(data) < 12:
+        raise IOError, "%s is not an HTK file, too short" % name
+    [L, fp, by, tc]  = struct.unpack('>LLhH', data[:12].tostring())
+    # Convert HTK units to seg
+    fp             = fp*1e-7
+    # DETERMINE DATA TYPE (lower six bits of TC)
+    dt = sum([(2**i)*((tc>>i)&1) for i in xrange(5, -1, -1)])
+    # DETERMINE STORAGE, ignoring anything after the data (e.g. the next
+    # record of an archive)
+    offset = 12
+    end    = min(len(data), 12 + by*L)
+    if tc & HASCRCC:
+        end  = min(end, len(data) - 2)
+        data = data[:end+2]
+    if dt in SHORT_KINDS or tc & HASCOMPX: 
+        dtype = np.dtype('>i2')
+    else:
+        dtype = np.dtype('>f4')
+    I = by/dtype.itemsize
+    # Compressed: scale and offset vectors after the header, they count
+    # as four frames
+    if dtype.itemsize == 2 and tc & HASCOMPX:
+        if dt in SHORT_KINDS:
+            raise ValueError, ("%s: 16 bit kinds can not be compressed"
+                               % name)
+        [A, B]  = data[offset:offset+8*I].view('>f4').reshape(2, I)
+        [A, B]  = [A.astype(float), B.astype(float)]
+        L      -= 4
+        offset += 8*I
+    # Files may be shorter than the header says if unfinished
+    if by:
+        L = max(min(L, (end - offset)/by), 0)
+    # Frames to read 
+    if frames is None:
+        frames = slice(None)
+    [start, stop, step] = frames.indices(L)
+    if step < 0:
+        raise ValueError, "Only increasing frames can be read"
+    n = max(stop - start, 0)
+    # CHECKSUM 
+    if check_crc and tc & HASCRCC:
+        if end < 12 or (binascii.crc_hqx(data[12:end].tostring(), 0) 
+                        != struct.unpack('>H', data[end:].tostring())[0]):
+            raise IOError, "%s: CRC check failed" % name
+    if mmap and dtype.itemsize == 2:
+        raise ValueError, "mmap only possible for 32 bit uncompressed data"
+    # READ REST
+    x = data[offset+by*start:offset+by*(start+n)].view(dtype).reshape(n, I)
+    x = x[::step]
+    if mmap:
+        x = x.T
+    elif dtype.itemsize == 4:
+        x = x.T.astype(float)
+    elif tc & HASCOMPX:
+        x = ((x + B)/A).T
+    elif dt == 5:
+        x = (x/32767.).T
+    else:
+        x = x.T.astype(float)
+
+    return [x, fp, dt, tc]
+
+
+def readhtkheaders(file_list, n_jobs=16):
+    '''
+    Reads only the headers of many HTK files, using n_jobs threads to keep
+    several reads in flight
+
+    Output: [N] structured ndarray with fields nSamples, sampPeriod, 
+            sampSize and parmKind (HTK_HEADER, native byte order). Note that
+            for compressed files nSamples counts four extra frames, see 
+            htkframes()
+    '''
+    buf = bytearray(12*len(file_list))
+
+    def read(n_range):
+        for n in n_range:
+            fd = os.open(file_list[n], os.O_RDONLY)
+            try:
+                header = os.read(fd, 12)
+            finally:
+                os.close(fd)
+            if len(header) < 12:
+                raise IOError, ("%s is not an HTK file, too short" 
+                                % file_list[n])
+            buf[12*n:12*n+12] = header
+
+    # Files are read in chunks to amortize the cost of dispatching
+    chunks = [xrange(n, min(n + 256, len(file_list))) 
+              for n in xrange(0, len(file_list), 256)]
+    if n_jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+        try:
+            pool.map(read, chunks)
+        finally:
+            pool.close()
+    else:
+        map(read, chunks)
+
+    return np.frombuffer(buf, HTK_HEADER).astype(HTK_HEADER.newbyteorder('='))
+
+
+def htkframes(headers):
+    '''
+    Number of frames of each file from the output of readhtkheaders()
+    '''
+    return (headers['nSamples'].astype(np.int64) 
+            - 4*((headers['parmKind'] & HASCOMPX) > 0))
+
+
+def scanhtk(scp_file, n_jobs=16, refresh=False):
+    '''
+    Reads the headers of all HTK files listed in an scp, e.g. to bucket 
+    utterances by length
+
+        headers = scanhtk('train.scp')
+        print htkframes(headers).sum()
+
+    The result is cached in scp_file + '.headers.npy' and used while it is
+    newer than the scp. Changes to the HTK files themselves are not
+    detected, use refresh=True. Failing to write the cache is not fatal.
+
+    Input: scp_file  string, path to an scp. For HCopy type scps (source 
+                     target) the targets are scanned
+    Input: n_jobs    int, number of threads reading
+    Input: refresh   bool, ignore the cache
+
+    Output: see readhtkheaders(), in the order of the scp
+    '''
+    [source_list, target_list] = readscp(scp_file)
+    if target_list is not None:
+        file_list = target_list
+    else:
+        file_list = source_list
+
+    # CACHED
+    cache_file = scp_file + '.headers.npy'
+    if (not refresh and os.path.isfile(cache_file) and 
+        os.path.getmtime(cache_file) >= os.path.getmtime(scp_file)):
+        try:
+            headers = np.load(cache_file)
+            if headers.dtype.names == HTK_HEADER.names and \
+               len(headers) == len(file_list):
+                return headers
+        except (IOError, ValueError):
+            pass
+
+    headers = readhtkheaders(file_list, n_jobs=n_jobs)
+    # Write and move, so that concurrent readers see complete files
+    try:
+        tmp_file = '%s.%d.tmp.npy' % (cache_file[:-4], os.getpid())
+        np.save(tmp_file, headers)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+    return headers
+
+
+def readhtkpacked(file_list, n_jobs=4, shuffle=False, seed=None, shard=None,
+                  variance=False):
+    '''
+    Reads many HTK files into a single packed float32 array, e.g. to load
+    training data. Headers are read first to size the array (see 
+    readhtkheaders()), then files are read by a pool of n_jobs threads 
+    straight into their span. 
+
+        [X, offsets, order] = readhtkpacked(readscp('train.scp')[0])
+        x = X[:, offsets[u]:offsets[u+1]]   # [I, L] of file_list[order[u]]
+
+    Input: file_list  list of paths to HTK files, all with the same number
+                      of features
+    Input: n_jobs     int, number of threads reading
+    Input: shuffle    bool, load the files in random order
+    Input: seed       int, seed of the random order
+    Input: shard      [k, n] load only the k-th of n shards of the (shuffled)
+                      files, shards are disjoint for the same seed
+    Input: variance   bool, features contain the variance of the mean
+                      appended (see HCo.py -up). Both are returned
+                      separately
+
+    Output: [X, offsets, order] X is [I, N] float32 with the N frames of all
+            files, in Fortran order so that each file is contiguous, 
+            offsets [U+1] the start of each file in X and order [U] the index
+            in file_list of each file
+
+    Output: [mu_X, Sigma_X, offsets, order] if variance is set
+    '''
+
+    # FILES TO LOAD
+    order = np.arange(len(file_list))
+    if shuffle:
+        order = np.random.RandomState(seed).permutation(order)
+    if shard is not None:
+        order = order[shard[0]::shard[1]]
+
+    pool = multiprocessing.pool.ThreadPool(n_jobs)
+    try:
+        # SIZE OF EACH FILE
+        headers  = readhtkheaders([file_list[n] for n in order], 
+                                  n_jobs=n_jobs)
+        itemsize = np.array([htkwriter.itemsize(tc) 
+                             for tc in headers['parmKind']], dtype=int)
+        L        = htkframes(headers)
+        dims     = headers['sampSize']/itemsize
+        if len(set(dims)) > 1:
+            raise ValueError, ("Files have different number of features: %s" 
+                               % sorted(set(dims)))
+        I = dims[0] if len(order) else 0
+        if variance:
+            if I % 2:
+                raise ValueError, ("Odd number of features %d, no variance "
+                                   "appended?" % I)
+            I /= 2
+        offsets = np.concatenate(([0], np.cumsum(L))).astype(np.int64)
+        X       = np.empty((I, offsets[-1]), dtype=np.float32, order='F')
+        if variance:
+            S   = np.empty((I, offsets[-1]), dtype=np.float32, order='F')
+
+        # READ
+        def fill(u):
+            htkfeats_file = file_list[order[u]]
+            # Float data is cast from the memory mapped file in one pass
+            x = readhtkfeats(htkfeats_file, mmap=itemsize[u] == 4)[0]
+            if x.shape[1] != L[u]:
+                raise IOError, ("%s has %d frames, header says %d" 
+                                % (htkfeats_file, x.shape[1], L[u]))
+            X[:, offsets[u]:offsets[u+1]] = x[:I]
+            if variance:
+                S[:, offsets[u]:offsets[u+1]] = x[I:]
+        pool.map(fill, range(len(order)))
+    finally:
+        pool.close()
+
+    if variance:
+        return [X, S, offsets, order]
+    return [X, offsets, order]
 
 
 def writehtkfeats(htkfeats_file, x, fp, tc):
@@ -169,102 +462,542 @@ def writehtkfeats(htkfeats_file, x, fp, tc):
 
     Input  fp            float    frame period in seconds
 
-    Input: tc            int      HTK targetkind in integer form              
+    Input: tc            int      HTK targetkind in integer form. 16 bit
+                                  kinds (WAVEFORM, IREFC, DISCRETE), 
+                                  compression (_C) and checksum (_K) are
+                                  supported, see htkwriter
     '''
 
-    # Get sizes
-    [I, L] = x.shape
-    # SANITY CHECK: We are not writing matrix transposed
-    if 4*I > 32767:
+    # SANITY CHECK: We are not writing matrix transposed, before creating
+    # the file
+    if htkwriter.itemsize(tc)*x.shape[0] > 32767:
         raise ValueError, ("Length of feature vectors to big, is matrix"
                           "tranposed?")
-    # SANITY CHECK: FOLDER EXISTS
-    htkfeats_folder = os.path.dirname(htkfeats_file)
-    if htkfeats_folder != '' and not os.path.isdir(htkfeats_folder):
-        raise IOError, "Folder %s does not exist" % htkfeats_folder
-    # Die if CRC (first bit of tc) solicited
-    if tc >> 31:
-        raise NotImplementedError, "CRC not supported, check tc value"
-    # Write file
-    with open(htkfeats_file, 'w') as fid:
+    with htkwriter(htkfeats_file, fp, tc) as fid:
+        fid.write(x)
+
+
+class htkwriter():
+    '''
+    Writes HTK features block by block, e.g. for chunked front-ends
+
+        with htkwriter('feats.mfc', 0.01, targetkind2num('MFCC_E')) as fid:
+            for x in ...:
+                fid.write(x)
+
+    The header is written with zero frames and patched with the number of 
+    frames on close(). Arguments as in writehtkfeats(), htkfeats_file can
+    also be a file open for writing, the features are then written at its
+    current position and the file is left open
+
+    16 bit kinds are rounded to integers, IREFC scaled from [-1, 1]. For 
+    compressed features (_C) each dimension is scaled to the 16 bit range
+    using its minimum and maximum over all frames, so blocks are kept in 
+    memory and written on close(). With _K a CRC-16 (CCITT) of the data 
+    is appended.
+    '''
+
+    def __init__(self, htkfeats_file, fp, tc):
+        # SANITY CHECK: HTK does not compress 16 bit kinds
+        if tc & HASCOMPX and (tc & 63) in SHORT_KINDS:
+            raise ValueError, "16 bit kinds can not be compressed"
+        # Open file, or write at the current position of an open one (e.g.
+        # an htkarchive)
+        if isinstance(htkfeats_file, str):
+            # SANITY CHECK: FOLDER EXISTS
+            htkfeats_folder = os.path.dirname(htkfeats_file)
+            if htkfeats_folder != '' and not os.path.isdir(htkfeats_folder):
+                raise IOError, "Folder %s does not exist" % htkfeats_folder
+            self.fid    = open(htkfeats_file, 'wb')
+            self.own    = True
+        else:
+            self.fid    = htkfeats_file
+            self.own    = False
+        self.start  = self.fid.tell()
+        self.fp     = fp
+        self.tc     = tc
+        self.I      = None
+        self.L      = 0
+        self.blocks = []
+        # Checksum of the data written so far
+        self.crc    = 0
+        self.closed = False
+        # Placeholder header
+        self.fid.write('\0'*12)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def itemsize(tc):
+        '''
+        Bytes per feature for HTK targetkind tc
+        '''
+        if (tc & 63) in SHORT_KINDS or tc & HASCOMPX:
+            return 2
+        return 4
+
+    def write(self, x):
+        '''
+        Appends x [I, L] features of L frames
+        '''
+        [I, L] = x.shape
+        # SANITY CHECK: We are not writing matrix transposed
+        if self.itemsize(self.tc)*I > 32767:
+            raise ValueError, ("Length of feature vectors to big, is matrix"
+                              "tranposed?")
+        if self.I is None:
+            self.I = I
+        elif I != self.I:
+            raise ValueError, ("Expected %d features per frame, got %d" 
+                               % (self.I, I))
+        self.L += L
+        # Compressed, scaling needs all frames
+        if self.tc & HASCOMPX:
+            self.blocks.append(np.array(x, dtype=float))
+        # WRITE BODY, frame after frame as big-endian int16 or float32
+        elif (self.tc & 63) == 5:
+            self.dump(np.round(x.T*32767.).astype('>i2'))
+        elif (self.tc & 63) in SHORT_KINDS:
+            self.dump(np.round(x.T).astype('>i2'))
+        else:
+            self.dump(np.asarray(x.T, dtype='>f4'))
+
+    def dump(self, data):
+        '''
+        Writes data as is to the file, updating the checksum if needed
+        '''
+        # Frame after frame, tofile() is slow for non contiguous data
+        data = np.ascontiguousarray(data)
+        if self.tc & HASCRCC:
+            data     = data.tostring()
+            self.crc = binascii.crc_hqx(data, self.crc)
+            self.fid.write(data)
+        else:
+            data.tofile(self.fid)
+
+    def close(self):
+        '''
+        Writes the final header and closes the file (if opened here)
+        '''
+        if self.closed:
+            return
+        L = self.L
+        I = self.I or 0
+        # COMPRESSED: scale and offset so that the range of each feature
+        # maps to [-32767, 32767], they are stored as four extra frames
+        if self.tc & HASCOMPX:
+            if L:
+                x    = np.concatenate(self.blocks, axis=1)
+                xmax = x.max(1)
+                xmin = x.min(1)
+                # Constant features
+                xmax[xmax == xmin] += 1
+            else:
+                x    = np.zeros((I, 0))
+                xmax = np.ones(I)
+                xmin = np.zeros(I)
+            A = (2*32767./(xmax - xmin)).astype('>f4')
+            B = ((xmax + xmin)*32767./(xmax - xmin)).astype('>f4')
+            self.dump(np.concatenate((A, B)).astype('>f4'))
+            # Compress with the stored values, so that decompression is exact
+            # up to rounding
+            x = x.T*A.astype(float) - B.astype(float)
+            self.dump(np.clip(np.round(x), -32767, 32767).astype('>i2'))
+            self.blocks = []
+            L          += 4
+        # CHECKSUM
+        if self.tc & HASCRCC:
+            self.fid.write(struct.pack('>H', self.crc))
         # WRITE HEADER
-        fid.write(struct.pack('>LLhh', L, round(fp*1.E7), 4*I, tc))
-        # WRITE BODY
-        fid.write(struct.pack('>'+'f'*I*L, *(x.T.ravel())))
+        self.fid.seek(self.start)
+        self.fid.write(struct.pack('>LLhH', L, round(self.fp*1.E7), 
+                                   self.itemsize(self.tc)*I, self.tc))
+        self.fid.seek(0, 2)
+        self.closed = True
+        if self.own:
+            self.fid.close()
 
 
-def readmlf(mlf_path):
+class htkarchive():
     '''
-    Reads an HTKs master label file returning a list of tuples containing
-    filename and the transcription
+    Archive of HTK feature files, to avoid the file system overhead of
+    millions of small files. The archive is a single data file with the
+    HTK files concatenated and an index, in Kaldi scp style, with lines
+
+        key ark_file:offset
+
+    Records are appended, and read by key from the memory mapped data
+    file, e.g.
+
+        with htkarchive('train.ark', 'w') as ark:
+            ark.write('utt1', x, 0.01, targetkind2num('MFCC_E'))
+
+        ark = htkarchive('train.ark')
+        [x, fp, dt, tc] = ark['utt1']
+
+    Input: ark_file    string, path to the data file 
+    Input: mode        'r' read, 'w' create, 'a' append to an existing
+                       archive (or create it) 
+    Input: index_file  string, path to the index, ark_file + '.scp' by
+                       default
+    '''
+
+    def __init__(self, ark_file, mode='r', index_file=None):
+        if index_file is None:
+            index_file = ark_file + '.scp'
+        if mode not in ['r', 'w', 'a']:
+            raise ValueError, "Unknown mode %s" % mode
+        self.ark_file   = ark_file
+        self.index_file = index_file
+        self.mode       = mode
+        # key -> [offset, size], in order of writing
+        self.records    = collections.OrderedDict()
+
+        # READ INDEX
+        if mode == 'r' or (mode == 'a' and os.path.isfile(index_file)):
+            if not os.path.isfile(index_file):
+                raise IOError, "Index %s does not exist" % index_file
+            with open(index_file) as fid:
+                for line in fid:
+                    if not line.strip():
+                        continue
+                    [key, location]   = line.split()
+                    self.records[key] = [int(location.rsplit(':', 1)[1]),
+                                         None]
+
+        if mode == 'r':
+            # Record sizes from the offsets, last record until end of file 
+            size   = os.path.getsize(ark_file)
+            starts = sorted(set([rec[0] for rec in self.records.values()]))
+            ends   = dict(zip(starts, starts[1:] + [size]))
+            for rec in self.records.values():
+                rec[1] = ends[rec[0]] - rec[0]
+            if size:
+                self.data = np.memmap(ark_file, 'u1', mode='r')
+            else:
+                self.data = np.zeros(0, 'u1')
+        else:
+            # Append after any previous content, records of interrupted
+            # writes not in the index are just skipped
+            if mode == 'a' and os.path.isfile(ark_file):
+                self.fid = open(ark_file, 'r+b')
+                self.fid.seek(0, 2)
+            else:
+                self.fid = open(ark_file, 'wb')
+            self.index_fid = open(index_file, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def keys(self):
+        return self.records.keys()
+
+    def read(self, key, frames=None, mmap=False, check_crc=False):
+        '''
+        Reads the features of key, see readhtkfeats() for the arguments
+        and output
+        '''
+        if self.mode != 'r':
+            raise IOError, "Archive %s not open for reading" % self.ark_file
+        if key not in self.records:
+            raise KeyError, "%s not in archive %s" % (key, self.ark_file)
+        return readhtkbuffer(self.record(key), frames=frames, mmap=mmap,
+                             check_crc=check_crc,
+                             name='%s:%s' % (self.ark_file, key))
+
+    def record(self, key):
+        '''
+        Content of the HTK file of key as stored, a uint8 ndarray
+        '''
+        [offset, size] = self.records[key]
+        # Size given by the header, skips bytes of interrupted writes
+        if size >= 12:
+            header         = self.data[offset:offset+12].tostring()
+            [L, _, by, tc] = struct.unpack('>LLhH', header)
+            size           = min(size, 12 + by*L + (2 if tc & HASCRCC else 0))
+        return self.data[offset:offset+size]
+
+    def write(self, key, x, fp, tc):
+        '''
+        Appends the features of key, see writehtkfeats() for the arguments
+        '''
+        self.checkkey(key)
+        offset = self.fid.tell()
+        with htkwriter(self.fid, fp, tc) as fid:
+            fid.write(x)
+        self.index(key, offset)
+
+    def append(self, key, htkfeats_file):
+        '''
+        Appends an HTK file as is 
+        '''
+        self.checkkey(key)
+        offset = self.fid.tell()
+        with open(htkfeats_file, 'rb') as fid:
+            self.fid.write(fid.read())
+        self.index(key, offset)
+
+    @staticmethod
+    def checkkey(key):
+        '''
+        Keys are written to the index, they can not contain white space. 
+        Checked before writing any data, so that no orphan records are left
+        '''
+        if len(key.split()) != 1 or key != key.strip():
+            raise ValueError, "Keys can not contain white space: '%s'" % key
+
+    def index(self, key, offset):
+        '''
+        Adds a record to the index, once its data is written
+        '''
+        self.fid.flush()
+        self.index_fid.write('%s %s:%d\n' % (key, self.ark_file, offset))
+        self.index_fid.flush()
+        self.records[key] = [offset, None]
+
+    def close(self):
+        if self.mode != 'r' and not self.fid.closed:
+            self.fid.close()
+            self.index_fid.close()
+
+
+def htk2ark(file_list, ark_file, keys=None, mode='w'):
+    '''
+    Stores HTK files as is in an htkarchive
+
+    Input: file_list  list of paths to HTK files e.g. from readscp()
+    Input: ark_file   string, path to the archive data file
+    Input: keys       list of keys, by default the file names without
+                      extension
+    Input: mode       'w' or 'a', see htkarchive
+    '''
+    if keys is None:
+        keys = [os.path.splitext(os.path.basename(htkfeats_file))[0]
+                for htkfeats_file in file_list]
+    with htkarchive(ark_file, mode) as ark:
+        for key, htkfeats_file in zip(keys, file_list):
+            ark.append(key, htkfeats_file)
+
+
+def ark2htk(ark_file, target_folder, file_term='mfc'):
+    '''
+    Extracts all records of an htkarchive as HTK files named
+    target_folder/key.file_term, returns their list
+    '''
+    ark       = htkarchive(ark_file)
+    file_list = []
+    for key in ark.keys():
+        htkfeats_file   = os.path.join(target_folder, key + '.' + file_term)
+        htkfeats_folder = os.path.dirname(htkfeats_file)
+        if htkfeats_folder and not os.path.isdir(htkfeats_folder):
+            os.makedirs(htkfeats_folder)
+        ark.record(key).tofile(htkfeats_file)
+        file_list.append(htkfeats_file)
+    return file_list
+
+
+def writesegments(lab_file, segs, fp, label='speech'):
+    '''
+    Writes segments as an HTK label file, one "start end label" line per
+    segment in HTK units (1e-7 secs)
+
+    Input: lab_file  string with path to the file to be written
+    Input: segs      [N, 2] start (included) and end (excluded) frame of each
+                     segment, see processing.signal.segments()
+    Input: fp        float frame period in seconds
+    Input: label     string label of all segments
+    '''
+    with open(lab_file, 'w') as fid:
+        for start, end in segs:
+            fid.write('%d %d %s\n' % (round(start*fp*1e7), round(end*fp*1e7),
+                                      label))
+
+
+def writehtkchunks(htkfeats_file, chunks, fp, tc, lab_file=None, up=False):
+    '''
+    Writes the features of a chunked front-end as a single HTK file, e.g.
+
+        fe = features.se_mfcc(feats, se, speech_only=True)
+        writehtkchunks('a.mfc', fe.stream(chunks), 0.01, tc, 'a.lab')
+
+    With speech_only only the speech frames are written, the label file
+    maps them back to time
+
+    Input: htkfeats_file string with path to the file to be written
+    Input: chunks        iterable of [mu_C, Sigma_C], [I, L] features of each
+                         chunk, or [mu_C, Sigma_C, segs] with the segments
+                         of the frames, see processing.features.se_mfcc
+    Input: fp            float frame period in seconds
+    Input: tc            int HTK targetkind, see writehtkfeats()
+    Input: lab_file      string, if given the segments of all chunks are
+                         written here, see writesegments()
+    Input: up            append the variances Sigma_C to the features, as
+                         HCo.py -up does
+    '''
+    segs = []
+    with htkwriter(htkfeats_file, fp, tc) as fid:
+        for chunk in chunks:
+            if up:
+                fid.write(np.concatenate(chunk[:2]))
+            else:
+                fid.write(chunk[0])
+            if len(chunk) > 2:
+                segs.extend(chunk[2])
+    if lab_file is not None:
+        # Join segments split at a chunk boundary
+        joined = []
+        for start, end in segs:
+            if joined and joined[-1][1] == start:
+                joined[-1][1] = end
+            else:
+                joined.append([start, end])
+        writesegments(lab_file, joined, fp)
+
+
+# MLF parsing patterns, see itermlf()
+MLF_NAME  = re.compile('^\"[^\"]+\.\'*\w+\'*\"$')
+MLF_SCORE = re.compile('-?[0-9]+')
+
+def itermlf(mlf_path, keytype=None, fill_names=False, numeric=False):
+    '''
+    Generator of (key, transcription) for each file of an HTKs master label
+    file, read as a stream. See HTKbook 3.4, page 87
+
+    Input: keytype     None, key is the file name as in the MLF, otherwise
+                       as in readmlf2dict()
+
+    Input: fill_names  bool, in state level transcriptions (start end state
+                       name auxname) append name and auxname of the model to
+                       all of its states, as readmlf2dict()
+
+    Input: numeric     bool, return each transcription as [times, labels]
+                       with times an [N, 2] int64 ndarray of start and end 
+                       (-1 if missing) and labels a list with a tuple of the
+                       remaining fields of each segment, with the name as 
+                       an interned string. By default it is a list of 
+                       segments as readmlf()
     '''
     # SANITY CHECK, paths exists
     if not os.path.exists(mlf_path):
         raise IOError, "ERROR path of MLF file  %s dos not exist" % (mlf_path)
-    # Open file safely
+
+    def entry(file_name, segments, times):
+        # Key 
+        if keytype == 'filename':
+            key = re.sub('\.[^\.]*$', '', os.path.split(file_name)[1])
+        elif keytype == 'filepath':
+            pieces = os.path.split(file_name)
+            key    = pieces[0] + '/' + pieces[1].split('.')[0]
+        else:
+            key = file_name
+        if numeric:
+            # All times parsed at once
+            times_str = ' '.join(times)
+            times     = np.fromstring(times_str, dtype=np.int64, sep=' ')
+            if times.size != 2*len(segments):
+                raise ValueError, ("Non integer times in transcription of %s" 
+                                   " in %s" % (file_name, mlf_path))
+            return (key, [times.reshape(-1, 2), segments])
+        return (key, segments)
+
+    # Times of segments with only name given
+    if numeric:
+        no_times = ['-1', '-1']
+    else:
+        no_times = [-1, -1]
+
+    # Open file safely, lines are read through a buffer
     with open(mlf_path) as fid_mlf:
-        mlf     = []          
         n_line  = 0
         in_sent = 0
-        names   = []  
-        for line in fid_mlf.readlines():
+        # If state numbers provided, the name and auxname are appended to
+        # all transcriptions (not just the first)
+        names   = []
+        for line in fid_mlf:
             # Skip comments
-            if re.match('\s*#.*', line):
+            if '#' in line and line.lstrip()[:1] == '#':
                 continue
             n_line += 1
             # In sentence transcription. If single '.' found transcription ends
             if in_sent:
-                if re.match('\.\n', line):
-                    mlf.append(sent_entry) 
+                if line == '.\n' or line == '.':
+                    yield entry(file_name, segments, times)
                     in_sent = 0
-                else:
-                    # Extract rich transcription
-                    #
-                    # [start [end] ] name [score] { auxname [auxscore] }
-                    # [comment]
-                    #
-                    items = line.rstrip().split()
-                    # Only word name given
-                    if len(items) == 1:
-                        sent_entry[1].append([-1, -1, items[0]])
-                    # Start, End, state, [name, auxname], last two missing
-                    # after start word
-                    elif len(items) == 3 and names != []:
-                        #sent_entry[1].append(items[:] + names)
-                        sent_entry[1].append(items[:])
-                    # Start, End and name
-                    # NOTE: this could also be "start name auxname/comment"
-                    # by we assume this is very unlikely
-                    elif len(items) == 3:
-                        sent_entry[1].append(items[:])
-                    elif len(items) == 4: 
-                        # Start, End, name, score
-                        if re.match('-?[0-9]+', items[3]):
-                            sent_entry[1].append(items[:])
-                        # Start, End, state, name
-                        else:
-                            #sent_entry[1].append(items[:] + [names[1]])
-                            sent_entry[1].append(items[:])
+                    continue
+                # Extract rich transcription
+                #
+                # [start [end] ] name [score] { auxname [auxscore] }
+                # [comment]
+                #
+                items = line.split()
+                # Only word name given
+                if len(items) == 1:
+                    items = no_times + items
+                # Start, End, state, [name, auxname], last two missing
+                # after start word
+                elif len(items) == 3:
+                    if fill_names:
+                        items += names
+                # NOTE: this could also be "start name auxname/comment"
+                # by we assume this is very unlikely
+                elif len(items) == 4: 
+                    # Start, End, state, name
+                    if not MLF_SCORE.match(items[3]):
+                        if fill_names:
+                            items += names[1:]
+                        if names:
                             names[0] = items[3]
-                    # Start, End, state, name, auxname
-                    elif len(items) == 5:
-                        sent_entry[1].append(items[:])
-                        names = items[3:]
-                    else:
-                        raise ValueError, ("Unknown transcription format in"
-                                           "line %d of"
-                                           "%s") % (n_line, mlf_path)
+                    # else Start, End, name, score
+                # Start, End, state, name, auxname
+                elif len(items) == 5:
+                    names = items[3:]
+                else:
+                    raise ValueError, ("Unknown transcription format in"
+                                       "line %d of"
+                                       "%s") % (n_line, mlf_path)
+                if numeric:
+                    times.append(items[0])
+                    times.append(items[1])
+                    items[2] = intern(items[2])
+                    segments.append(tuple(items[2:]))
+                else:
+                    segments.append(items)
             # In sentence name
-            elif re.match('^\"[^\"]+\.\'*\w+\'*\"$', line):
-                # Create a new sentence entry that will be appended to the mlf
-                # list when we exit the transcription
-                sent_entry = [line.rstrip().replace("\"", ""), []]
-                in_sent    = 1
+            elif MLF_NAME.match(line):
+                file_name = line.rstrip().replace("\"", "")
+                segments  = []
+                times     = []
+                in_sent   = 1
             else:
                 raise ValueError, (("Missing sentence start at line %d of %s") 
                                    % (n_line, mlf_path))
-    # Return separately
-    return mlf 
+        # Last transcription not terminated
+        if in_sent:
+            yield entry(file_name, segments, times)
+
+
+def readmlf(mlf_path):
+    '''
+    Reads an HTKs master label file returning a list of tuples containing
+    filename and the transcription
+    '''
+    return [[name, segments] for name, segments in itermlf(mlf_path)]
 
 
 def writemlf(mlf, mlf_path, file_term='lab'):
@@ -288,7 +1021,7 @@ def writemlf(mlf, mlf_path, file_term='lab'):
             fid.write(" ".join(word[:2] + [str(word[2])]  + word[3:]) + '\n')
         fid.write('.\n')
 
-def readmlf2dict(mlf_path, keytype = 'filename'):
+def readmlf2dict(mlf_path, keytype = 'filename', cache=None):
     '''
     READMLF2DICT: Reads an HTKs master label file returning a dictionary
     indexed by filename. Each dictionary entry contains a list with each
@@ -303,97 +1036,186 @@ def readmlf2dict(mlf_path, keytype = 'filename'):
              'filename'   basename used 
              'filepath'   whole path is used
 
+    Input cache, if an mlfcache is given the MLF is parsed only once and
+    a read-only mlfview returned instead, see mlfcache.read()
     '''
-    # SANITY CHECK, paths exists
-    if not os.path.exists(mlf_path):
-        raise IOError, "ERROR path of MLF file  %s dos not exist" % (mlf_path)
+    if cache is not None:
+        return cache.read(mlf_path, keytype=keytype)
+    return dict(itermlf(mlf_path, keytype=keytype, fill_names=True))
 
-    # Open file safely
-    with open(mlf_path) as fid_mlf:
 
-        # Atempt to extract the file content as chunks of filename followed by
-        # rich transcription (at least labels, eventually timestamps and
-        # log-likelihoods)
+class mlfview(collections.Mapping):
+    '''
+    Read-only dictionary view of a parsed MLF, as returned by readmlf2dict(),
+    stored in columnar form. Transcriptions are only built when accessed.
+    Use dict(view) for a modifiable copy. 
 
-        # THIS DOES NOT WORK AS SOME WORDS CONTAIN THE TOKEN "."
-  # att_match = re.findall('\"([^\"]*)\.rec\"\n([^\.]+\n)\.\n', fid_mlf.read())
+    Columns are given as a dictionary of arrays (possibly memory mapped)
 
-        # Initialize dictionary
-        trans_dict = {}
+        names    [U] sorted keys
+        offsets  [U+1] first segment of each key
+        times    [N, 2] int64 start and end of each segment, -1 if missing
+        fields   [N, 3] int32 index in vocab of name and up to two more 
+                 fields (score, auxname ...) of each segment, -1 if missing
+        vocab    [V] strings of the fields
 
-        n_line = 0
-        # State
-        in_sent = 0
-        names = []  # If state numbers provided, the name and auxname are
-                  # appended to all transcriptions (not just the first)
-        # For each line
-        for line in fid_mlf.readlines():
+    Note that start and end are returned as str(int), leading zeros in the
+    MLF are lost.
+    '''
 
-            # Skip comments
-            if re.match('\s*#.*', line):
-                continue
+    COLUMNS = ['names', 'offsets', 'times', 'fields', 'vocab']
+
+    def __init__(self, columns):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def fromiter(cls, transcriptions):
+        '''
+        Builds the columns from (key, [times, labels]) as given by 
+        itermlf() with numeric=True. Repeated keys keep the last one
+        '''
+        entries = dict(transcriptions)
+        keys    = sorted(entries)
+        vocab   = {}
+        fields  = []
+        offsets = [0]
+        for key in keys:
+            for labels in entries[key][1]:
+                ids = [vocab.setdefault(label, len(vocab)) for label in labels]
+                fields.append(ids + [-1]*(3 - len(ids)))
+            offsets.append(len(fields))
+        if keys:
+            times = np.concatenate([entries[key][0] for key in keys])
+        else:
+            times = np.zeros((0, 2), dtype=np.int64)
+        words = [None]*len(vocab)
+        for label, i in vocab.iteritems():
+            words[i] = label
+        return cls({'names': np.array(keys, dtype=str), 
+                    'offsets': np.array(offsets, dtype=np.int64),
+                    'times': times, 
+                    'fields': np.array(fields, dtype=np.int32).reshape(-1, 3),
+                    'vocab': np.array(words, dtype=str)})
+
+    def index(self, key):
+        '''
+        Position of key in the columns, None if not found
+        '''
+        if not isinstance(key, str):
+            return None
+        u = np.searchsorted(self.names, key)
+        if u < len(self.names) and self.names[u] == key:
+            return u
+        return None
+
+    def __getitem__(self, key):
+        u = self.index(key)
+        if u is None:
+            raise KeyError, key
+        # All segments of the key at once
+        [start, end] = self.offsets[u:u+2]
+        fields       = self.fields[start:end]
+        words        = self.vocab[np.maximum(fields, 0)].tolist()
+        segments     = []
+        for times, ids, labels in zip(self.times[start:end].tolist(), 
+                                      fields.tolist(), words):
+            segment = [-1 if t == -1 else str(t) for t in times]
+            segments.append(segment + [label for i, label in zip(ids, labels)
+                                       if i >= 0])
+        return segments
+
+    def __contains__(self, key):
+        return self.index(key) is not None
+
+    def __iter__(self):
+        return (str(key) for key in self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self)
+
+
+# Folder of the on-disk cache of parsed MLFs, see mlfcache
+MLF_CACHE = os.path.join(os.path.expanduser('~'), '.obsunc', 'mlf')
+
+class mlfcache():
+    '''
+    On-disk cache of MLFs parsed by readmlf2dict(), e.g.
 
-            n_line += 1
-            if in_sent:
-                # If single '.' found, sentence ended
-                if re.match('\.\n', line):
-                    in_sent = 0
-                else:
+        cache      = mlfcache()
+        trans_dict = readmlf2dict(mlf_path, cache=cache)
 
-                    # Extract rich transcription
-                    #
-                    # [start [end] ] name [score] { auxname [auxscore] }
-                    # [comment]
-                    #
-                    items = line.rstrip().split()
-                    # Only word name given
-                    if len(items) == 1:
-                        trans_dict[key_name].append([-1, -1, items[0]])
-                    # Start, End, state, [name, auxname], last two missing
-                    # after start word
-                    elif len(items) == 3 and names != []:
-                        trans_dict[key_name].append(items[:] + names)
-                    # Start, End and name
-                    # NOTE: this could also be "start name auxname/comment"
-                    # by we assume this is very unlikely
-                    elif len(items) == 3:
-                        trans_dict[key_name].append(items[:])
-                    elif len(items) == 4: 
-                        # Start, End, name, score
-                        if re.match('-?[0-9]+', items[3]):
-                            trans_dict[key_name].append(items[:])
-                        # Start, End, state, name
-                        else:
-                            trans_dict[key_name].append(items[:] + [names[1]])
-                            names[0] = items[3]
-                    # Start, End, state, name, auxname
-                    elif len(items) == 5:
-                        trans_dict[key_name].append(items[:])
-                        names = items[3:]
-                    else:
-                        raise ValueError, ("Unknown transcription format in"
-                                           "line %d of"
-                                           "%s") % (n_line, mlf_path)
+    Entries are keyed by path, size, modification time and keytype, so that 
+    entries of MLFs that changed are never used and are deleted when found.
+    Each entry is a folder with the columns of an mlfview as .npy files,
+    which are memory mapped when read.
 
-            else:
-                # Sentence transcription starts
-                if re.match('^\"[^\"]+\.\'*\w+\'*\"$', line):
-                    file_name = line.rstrip().replace("\"", "")
-                    if keytype == 'filename':
-                        key_name = re.sub('\.[^\.]*$', '',
-                                          os.path.split(file_name)[1])
-                    elif keytype == 'filepath':
-                        pieces = os.path.split(file_name)
-                        key_name = ( pieces[0] + '/'
-                                    + pieces[1].split('.')[0])
-                    trans_dict[key_name] = []
-                    in_sent = 1
-                else:
-                    raise ValueError, ("Missing sentence start at"
-                                       "line %d of %s") % (n_line, mlf_path)
+    Input: cache_folder  string, folder of the store, MLF_CACHE by default
+    '''
 
-    # Return separately
-    return trans_dict
+    def __init__(self, cache_folder=None):
+        if cache_folder is None:
+            cache_folder = MLF_CACHE
+        self.cache_folder = cache_folder
+
+    def key(self, mlf_path, keytype):
+        '''
+        Cache key of an MLF, [name, stamp] where name identifies the file
+        and keytype and stamp its current version
+        '''
+        mlf_path = os.path.abspath(mlf_path)
+        stat     = os.stat(mlf_path)
+        name     = hashlib.sha1(repr((mlf_path, keytype))).hexdigest()
+        return [name, '%d_%d' % (stat.st_size, round(stat.st_mtime*1e6))]
+
+    def read(self, mlf_path, keytype='filename'):
+        '''
+        Same as readmlf2dict() but using the cache, returns an mlfview
+        '''
+        if not os.path.exists(mlf_path):
+            raise IOError, ("ERROR path of MLF file  %s dos not exist" 
+                            % (mlf_path))
+        [name, stamp] = self.key(mlf_path, keytype)
+        entry_folder  = os.path.join(self.cache_folder, '%s_%s' % (name, stamp))
+
+        # Remove entries of older versions of this MLF
+        for old_folder in glob.glob(os.path.join(self.cache_folder, 
+                                                 name + '_*')):
+            if old_folder != entry_folder and not old_folder.endswith('.tmp'):
+                shutil.rmtree(old_folder, ignore_errors=True)
+
+        # CACHED
+        if os.path.isdir(entry_folder):
+            try:
+                return mlfview(dict([(column, 
+                    np.load(os.path.join(entry_folder, column + '.npy'), 
+                            mmap_mode='r')) for column in mlfview.COLUMNS]))
+            except (IOError, ValueError):
+                pass
+
+        # Parse and store. MLFs with non integer times can not be stored
+        try:
+            view = mlfview.fromiter(itermlf(mlf_path, keytype=keytype, 
+                                            fill_names=True, numeric=True))
+        except ValueError:
+            return readmlf2dict(mlf_path, keytype=keytype)
+        # Write and move, so that concurrent readers see complete entries.
+        # Failing to do so is not fatal
+        try:
+            tmp_folder = '%s.%d.tmp' % (entry_folder, os.getpid())
+            if not os.path.isdir(tmp_folder):
+                os.makedirs(tmp_folder)
+            for column in mlfview.COLUMNS:
+                np.save(os.path.join(tmp_folder, column + '.npy'), 
+                        getattr(view, column))
+            os.rename(tmp_folder, entry_folder)
+        except (IOError, OSError):
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+        return view
 
 def writemlf_fromdict(trans_dict, mlf_path, file_term='lab'):
     '''
@@ -452,7 +1274,12 @@ def writemlf_fromdict(trans_dict, mlf_path, file_term='lab'):
 def mlf_reg2key(token, mlf_dict, strict=False, unique=True):
     '''
     Sees if sentecne matches a regular expression of paths in a MLF
+
+    A plain dictionary is scanned key by key. For repeated lookups pass an 
+    mlfindex of the dictionary instead, it gives the same result
     ''' 
+    if isinstance(mlf_dict, mlfindex):
+        return mlf_dict.reg2key(token, strict=strict, unique=unique)
     if unique:
         for pathregxp in mlf_dict.keys():
             if re.match(pathregxp.replace('*','.*'), token):
@@ -478,6 +1305,109 @@ def mlf_reg2key(token, mlf_dict, strict=False, unique=True):
         return matches
 
 
+# Characters with special meaning in the keys of mlf_reg2key(), other than
+# '.' which mlfindex handles separately
+MLF_REGEXP_CHARS = re.compile(r'[\^$*+?{}\[\]\\|()]')
+
+class mlfindex():
+    '''
+    Index of the keys of an MLF dictionary (see readmlf2dict()) for fast
+    mlf_reg2key() lookups, e.g.
+
+        index = mlfindex(mlf_dict)
+        key   = index.reg2key(token)
+
+    Keys are regular expressions (with * for .*) matched at the start of
+    the token. To avoid testing all of them
+
+        keys without special characters, other than '.', start with a 
+        literal stem (the part before the first '.'), looked up as prefix
+        of the token in a hash map per length
+
+        keys of the form */name.lab (name.lab as above) contain the literal
+        stem /name, looked up as substring of the token starting at a '/' 
+        in a hash map per length for each '/' of the token
+
+    The '.' of e.g. the extension matches any character, so each stem hit
+    is confirmed against the rest of the key. Only the remaining keys are 
+    tested on every lookup, as precompiled patterns. The index is not 
+    updated if mlf_dict changes.
+    '''
+
+    def __init__(self, mlf_dict):
+        # Position of each key, matches are returned in this order
+        self.keys     = list(mlf_dict.keys())
+        self.prefixes = {}
+        self.suffixes = {}
+        self.patterns = []
+        for n, key in enumerate(self.keys):
+            if not MLF_REGEXP_CHARS.search(key) and key[:1] != '.':
+                self.prefixes.setdefault(key.split('.')[0], []).append(n)
+            elif key[:2] == '*/' and not MLF_REGEXP_CHARS.search(key[1:]):
+                self.suffixes.setdefault(key[1:].split('.')[0], []).append(n)
+            else:
+                self.patterns.append((n, re.compile(key.replace('*','.*'))))
+        self.prefix_lengths = sorted(set(map(len, self.prefixes)))
+        self.suffix_lengths = sorted(set(map(len, self.suffixes)))
+
+    @staticmethod
+    def wildmatch(pattern, text):
+        '''
+        True if text matches pattern, where '.' stands for any character
+        '''
+        if len(pattern) != len(text):
+            return False
+        for p, c in zip(pattern, text):
+            if p != c and (p != '.' or c == '\n'):
+                return False
+        return True
+
+    def match(self, token):
+        '''
+        Positions in self.keys of all keys matching token, sorted
+        '''
+        matches = []
+        for length in self.prefix_lengths:
+            if length > len(token):
+                break
+            for n in self.prefixes.get(token[:length], []):
+                key = self.keys[n]
+                if self.wildmatch(key, token[:len(key)]):
+                    matches.append(n)
+        if self.suffixes:
+            start = token.find('/')
+            while start >= 0:
+                for length in self.suffix_lengths:
+                    if start + length > len(token):
+                        break
+                    name = token[start:start+length]
+                    for n in self.suffixes.get(name, []):
+                        key = self.keys[n][1:]
+                        if self.wildmatch(key, token[start:start+len(key)]):
+                            matches.append(n)
+                start = token.find('/', start + 1)
+        for n, pattern in self.patterns:
+            if pattern.match(token):
+                matches.append(n)
+        # A stem may occur more than once in the token
+        return sorted(set(matches))
+
+    def reg2key(self, token, strict=False, unique=True):
+        '''
+        Same as mlf_reg2key()
+        '''
+        matches = self.match(token)
+        if not matches:
+            if strict:
+                raise EnvironmentError, ("An MLF was provided but it has no "
+                                         "transcription%s for %s" 
+                                         % ('' if unique else 's', token))
+            return None
+        if unique:
+            return self.keys[matches[0]]
+        return [self.keys[n] for n in matches]
+
+
 def readscp(scp_file, append_source=''):
     '''
     Read scp file. Append append_source to the source_file
@@ -517,3 +1447,45 @@ def writescp(scp_file, file_list):
         else:
             for n, ffile in enumerate(file_list[0]):
                 f.write('%s\t%s\n' % (ffile, file_list[1][n]))
+
+
+def benchmark(n_files=100000, n_segments=20, repeat=3):
+    '''
+    Prints the parsing speed of readmlf2dict() and of itermlf() with numeric
+    output on a synthetic word level MLF
+
+    Input: n_files     number of transcriptions in the MLF 
+    Input: n_segments  number of segments of each transcription
+    Input: repeat      the best of this number of runs is reported
+    '''
+    import time
+    rs  = np.random.RandomState(0)
+    fid = tempfile.NamedTemporaryFile(suffix='.mlf', delete=False)
+    try:
+        fid.write('#!MLF!#\n')
+        for n in range(n_files):
+            fid.write('"*/utt%07d.rec"\n' % n)
+            ends = np.cumsum(rs.randint(1, 100, n_segments))*100000
+            for start, end, word in zip(np.concatenate(([0], ends[:-1])),
+                                        ends, rs.randint(0, 5000, n_segments)):
+                fid.write('%d %d w%d -%.4f\n' % (start, end, word, 
+                                                 rs.rand()*1000))
+            fid.write('.\n')
+        fid.close()
+        size = os.path.getsize(fid.name)/2.**20
+        for name, parse in [('readmlf2dict', readmlf2dict),
+                            ('itermlf numeric', 
+                             lambda mlf_path: list(itermlf(mlf_path,
+                                                           numeric=True)))]:
+            best = np.inf
+            for r in range(repeat):
+                t0   = time.time()
+                parse(fid.name)
+                best = min(best, time.time() - t0)
+            print "%-16s %8.0f files/s %6.1f MB/s" % (name, n_files/best, 
+                                                       size/best)
+    finally:
+        os.remove(fid.name)
+
+if __name__ == '__main__':
+    benchmark()
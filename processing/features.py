@@ -215,6 +215,88 @@ class mfcc():
         return [mu_y,Sigma_y]
 
 
+#################################################
+# STREAMING ENHANCEMENT AND UNCERTAIN MFCCS
+#################################################
+
+class se_mfcc():
+
+    '''
+    Fused speech enhancement and uncertainty propagation into MFCCs. Each
+    chunk of STFT frames is enhanced (e.g. with imcra.imcra_se) and the
+    enhanced STFT and residual MSE of the Wiener filter are passed to
+    mfcc.extract_up() right away. Only the current chunk is kept in memory.
+
+    If speech_only is set, features are computed only for the frames the
+    enhancement marks as speech, see imcra.imcra_se.detect_speech(). The
+    segments these frames belong to are returned as well, so that the
+    features can be mapped back to the original time axis.
+    interfaces.htk.writehtkchunks() writes the output of stream() as an
+    HTK feature file and a label file with the segments.
+
+    Input: feats        mfcc instance
+    Input: se           enhancement instance with update() and pop_param(),
+                        e.g. imcra.imcra_se
+    Input: diagcov_flag see mfcc.extract_up()
+    Input: speech_only  only process speech frames, needs se to provide a
+                        speech mask, single stream only 
+    '''
+
+    def __init__(self, feats, se, diagcov_flag=1, speech_only=False):
+        self.feats        = feats
+        self.se           = se
+        self.diagcov_flag = diagcov_flag
+        self.speech_only  = speech_only
+        # Frames processed so far
+        self.l            = 0
+        # SANITY CHECK: There is a speech mask to use
+        if speech_only and (getattr(se, 'speech_threshold', None) is None 
+                            or se.B != 1):
+            raise ValueError, ("speech_only needs a single stream enhancement"
+                               " with speech_threshold set")
+
+    def update(self, Y):
+        '''
+        Enhance a chunk of STFT frames and compute uncertain MFCCs
+
+        Input: Y  [K, L] STFT chunk or [K, B, L] for B streams
+
+        Output: [mu_C, Sigma_C] [I, L] or [I, B, L] for B streams
+
+        Output: [mu_C, Sigma_C, segs] if speech_only is set. Features have
+                only the speech frames, segs are their [N, 2] start and
+                end frames counted from the first chunk, see
+                signal.segments()
+        '''
+        hat_X   = self.se.update(Y)
+        [MSE]   = self.se.pop_param(['MSE'])
+        L0      = hat_X.shape[-1]
+        self.l += L0
+        if self.speech_only:
+            speech  = self.se.speech
+            [mu_C,
+             Sigma_C] = self.feats.extract_up(hat_X[:, speech], MSE[:, speech],
+                                              self.diagcov_flag)
+            return [mu_C, Sigma_C, sip.segments(speech, self.l - L0)]
+        # Streams are processed as extra frames
+        shape   = hat_X.shape
+        K, L    = shape[0], np.prod(shape[1:])
+        [mu_C, 
+         Sigma_C] = self.feats.extract_up(hat_X.reshape(K, L), 
+                                          MSE.reshape(K, L), self.diagcov_flag)
+        I       = mu_C.shape[0]
+        return [mu_C.reshape((I,) + shape[1:]), 
+                Sigma_C.reshape((I,) + shape[1:])]
+
+    def stream(self, chunks):
+        '''
+        Generator version of update() for an iterable of STFT chunks, yields
+        [mu_C, Sigma_C] for each chunk
+        '''
+        for Y in chunks:
+            yield self.update(Y)
+
+
 #################################################
 # DELTAS AND ACCELERATIONS
 #################################################
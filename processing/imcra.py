@@ -7,10 +7,29 @@ noise estmation after
     Improved Minima Controlled Recursive Averaging. IEEE. Trans. Acoust.
     Speech Signal Process. VOL. 11, NO. 5, Sep 2003.
 
+Lower complexity estimators sharing the same interface are also provided,
+see the minstat, mcra and spp classes
+
+    [2] Rainer Martin, Noise Power Spectral Density Estimation Based on
+    Optimal Smoothing and Minimum Statistics. IEEE Trans. Speech Audio
+    Process. VOL. 9, NO. 5, Jul 2001.
+
+    [4] Israel Cohen, Baruch Berdugo, Noise Estimation by Minima Controlled
+    Recursive Averaging for Robust Speech Enhancement. IEEE Signal Process.
+    Lett. VOL. 9, NO. 1, Jan 2002.
+
+    [5] Timo Gerkmann, Richard C. Hendriks, Unbiased MMSE-Based Noise Power
+    Estimation With Low Complexity and Low Tracking Delay. IEEE Trans.
+    Audio Speech Lang. Process. VOL. 20, NO. 4, May 2012.
+
 Ramon F. Astudillo Feb2015
 '''
 
+import itertools
 import numpy as np
+import scipy.ndimage
+import scipy.signal
+import scipy.stats
 import sys
 import os
 # Add the path of the toolbox root
@@ -18,6 +37,7 @@ root_path = os.path.dirname(os.path.realpath(__file__)) + '/../'
 sys.path.append(root_path)
 
 import processing.signal as sip
+import processing.imcra_jit as imcra_jit
 # For debugging purposes
 #import ipdb 
 #np.seterr(divide='ignore',invalid='raise')
@@ -34,7 +54,7 @@ def post_speech_prob(Y_l, q, Gamma, xi):
     
     '''
     nu       = Gamma*xi/(1+xi)
-    p        = np.zeros(Y_l.shape)
+    p        = np.zeros(q.shape)
     p[q < 1] = 1./(1+(q[q < 1]/(1-q[q < 1]))*(1+xi[q < 1])*np.exp(-nu[q < 1]))
 
     return p
@@ -56,118 +76,555 @@ def sym_hanning(n):
     w    = .5*(1 - np.cos(2*np.pi*np.arange(1,half+1)/(n+1)))
     return np.concatenate((w, w[:-1]));
 
+def thresholds(w, alpha_s, epsilon, epsilon1):
+    '''
+    VAD thresholds and noise bias correction for given significance levels
+    and smoothing parameters, see [1, App. II]. 
+
+    Note: This STILL assumes that we use the posterior probability as
+    defined by [1, Eq. 7]
+
+    Output: [Gamma0, Gamma1, zeta0, beta]
+    '''
+    # Approx degrees of freedom of Eq. 20, see App. II
+    mu     = (1+alpha_s)/(1-alpha_s)*(1 + 0.7*w)
+    # Treshold to achieve epsilon significance in first VAD speech absence
+    # hypothesis test
+    Gamma0 = -np.log(epsilon)
+    zeta0  = scipy.stats.chi2.ppf(1-epsilon, mu)/mu
+    # Treshold to achieve epsilon1 significance in second VAD speech
+    # presence hypothesis test
+    Gamma1 = -np.log(epsilon1)
+    # Noise variance estimate bias for speech absence [1, Eq. 31]
+    beta   = ((Gamma1 - 1 - np.exp(-1) + np.exp(-Gamma1))/
+              (Gamma1 - 1 - 3*np.exp(-1) + (Gamma1+2)*np.exp(-Gamma1)))
+
+    return [Gamma0, Gamma1, zeta0, beta]
+
+def calibrate(nfft, w=1, alpha_s=0.9, U=8, V=15, epsilon=0.01, epsilon1=0.05,
+              windowsize=None, shift=None, cache_folder=None):
+    '''
+    Minimum statistic bias Bmin and VAD thresholds for an IMCRA
+    configuration. Bmin is computed with imcra.setBmin() on the STFT of a
+    long white noise signal, framed as the signal to be processed. Results
+    are kept in memory keyed by the configuration and framing, so this only
+    costs time the first time a configuration is used. They are also 
+    cached on disk, to reuse them across processes. Used by imcra when 
+    Bmin='calibrate' is given.
+
+    Input: windowsize    int, STFT window in samples, nfft by default
+    Input: shift         int, STFT shift in samples, windowsize/2 by default
+    Input: cache_folder  string, folder for the disk cache, CALIB_CACHE by
+                         default. Set to '' to disable it
+
+    Output: [Bmin, Gamma0, Gamma1, zeta0, beta]
+    '''
+    if windowsize is None:
+        windowsize = nfft
+    if shift is None:
+        shift      = windowsize/2
+    if cache_folder is None:
+        cache_folder = CALIB_CACHE
+    config = (nfft, windowsize, shift, w, alpha_s, U, V, epsilon, epsilon1)
+    if config in CALIBRATED:
+        return list(CALIBRATED[config])
+    if cache_folder:
+        cache_file = os.path.join(cache_folder, 
+                                  'nfft%d_win%d_sh%d_w%d_as%g_U%d_V%d_e%g_'
+                                  'e1%g.npy' % config)
+        if os.path.isfile(cache_file):
+            try:
+                CALIBRATED[config] = list(np.load(cache_file))
+                return list(CALIBRATED[config])
+            except (IOError, ValueError):
+                pass
+
+    # Calibrate on a fixed white noise realization of 50 minimum windows
+    imc   = imcra(nfft, Bmin=1., w=w, alpha_s=alpha_s, U=U, V=V,
+                  epsilon=epsilon, epsilon1=epsilon1)
+    n     = np.random.RandomState(0).randn((50*U*V + 1)*shift)
+    Bmin  = imc.setBmin(sip.stft(n, windowsize, shift, nfft))
+    calib = [Bmin, imc.Gamma0, imc.Gamma1, imc.zeta0, imc.beta]
+    CALIBRATED[config] = calib
+
+    # Write to disk cache, failing to do so (e.g. read-only home) is not 
+    # fatal
+    if cache_folder:
+        try:
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            # Write and move, so that concurrent readers see complete files
+            tmp_file = '%s.%d.npy' % (cache_file[:-4], os.getpid())
+            np.save(tmp_file, np.array(calib))
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            pass
+
+    return calib
+
+def sweep(Y, nfft, grid, metric=None, **kwargs):
+    '''
+    Runs one imcra_se per configuration of a parameter grid over the same
+    STFT. All configurations are advanced in lock-step as the streams of a
+    single imcra_se, so the spectrogram is read once per frame.
+
+    Input: Y      [K, L] STFT
+    Input: grid   dict of parameter name to list of values. The cartesian
+                  product of all lists is run. Parameters can be those of
+                  imcra_se (alpha, xi_min, IS, Bmin) and imcra (alpha_s,
+                  alpha_d, epsilon, epsilon1). w, U, V and the framing
+                  (windowsize, shift) can not be swept
+    Input: metric function metric(hat_X, MSE) of the [K, L] enhanced STFT
+                  and residual MSE of one configuration. If given, only its
+                  value is returned for each configuration
+    Input: kwargs fixed parameters passed to imcra_se 
+
+    Output: [configs, results] list of dicts with the parameters of each
+            configuration and either hat_X [K, B, L] or the list of metric
+            values
+    '''
+    for par in ['w', 'U', 'V', 'windowsize', 'shift']:
+        if par in grid and len(grid[par]) > 1:
+            raise ValueError, "%s changes buffer sizes and can not be swept" % par
+
+    # Expand grid into per-stream parameter arrays
+    names   = sorted(grid.keys())
+    configs = [dict(zip(names, vals)) 
+               for vals in itertools.product(*[grid[n] for n in names])]
+    B       = len(configs)
+    for n in names:
+        kwargs[n] = np.array([config[n] for config in configs])
+        # Buffer sizes must be scalars
+        if n in ['w', 'U', 'V', 'windowsize', 'shift']:
+            kwargs[n] = kwargs[n][0]
+
+    se    = imcra_se(nfft, B=B, **kwargs)
+    hat_X = se.update(Y)
+    if B == 1:
+        hat_X = hat_X[:, None, :]
+
+    if metric is None:
+        return [configs, hat_X]
+    else:
+        MSE = se.store['MSE'][:, :, :se.l]
+        return [configs, [metric(hat_X[:, b, :], MSE[:, b, :]) 
+                          for b in range(B)]]
 
 # Default buffer size
 L_MAX = 1000
 
+# Default minimum statistic bias, calibrated for the author's setup. Pass
+# Bmin='calibrate' to compute it for the configuration, see calibrate()
+BMIN        = 2.1
+
+# Folder where calibrated Bmin and thresholds are cached on disk, see
+# calibrate(). Set to '' to disable it
+CALIB_CACHE = os.path.join(os.path.expanduser('~'), '.obsunc', 'imcra')
+
+# Calibrations computed by this process, see calibrate()
+CALIBRATED  = {}
+
+# Buffers and counters of the imcra class that make up its state, in the order
+# they are stored by imcra.get_state()
+IMCRA_STATE = ['S', 'Smin', 'tilde_S', 'tilde_Smin', 'Smin_sw', 'tilde_Smin_sw',
+               'Storing', 'tilde_Storing', 'ov_Lambda_D', 'Lambda_D', 'q', 'p',
+               'l', 'j', 'u']
+
 class imcra_se():
     '''
     Simple class for enhancement using IMCRA 
+
+    Several streams (e.g. microphones of an array or a batch of utterances)
+    can be advanced in lock-step by setting B > 1. Each of them is enhanced
+    independently.
+
+    If Numba is installed and jit is set, update() runs a JIT compiled
+    version of the whole recursion, see imcra_jit.py. parity() checks it
+    against the NumPy version
+
+    The noise estimator can be replaced by any class with the interface of
+    the imcra class, e.g. the cheaper minstat, mcra or spp, see noise
+
+    If speech_threshold is set, each update also leaves a frame-level speech
+    mask for the processed frames in self.speech, see detect_speech()
+
+    Bmin is BMIN by default. With Bmin='calibrate' it is calibrated for the
+    configuration, see calibrate(). Pass the STFT windowsize and shift in
+    kwargs then, if they are not nfft and nfft/2
+
+    The parameters alpha, xi_min, IS, Bmin and those of the imcra class
+    passed in kwargs (except w, U, V, windowsize and shift) can also be
+    given per stream as [B] arrays, see sweep()
     '''
-    def __init__(self, nfft, Lambda_D=None, alpha =0.92, xi_min=10**(-25./20), IS=10):
+    def __init__(self, nfft, Lambda_D=None, alpha =0.92, xi_min=10**(-25./20), IS=10,
+                 B=1, jit=True, Bmin=BMIN, noise=None, speech_threshold=None,
+                 hangover=10, **kwargs):
 
         # Decision directed smoothing factor
         self.alpha  = alpha
         # Decision directed a priori SNR floor
         self.xi_min = xi_min
+        # Number of streams
+        self.B      = B
+        # Use JIT compiled back-end if available
+        self.jit    = jit and imcra_jit.HAVE_NUMBA
+        # Frame-level speech detection: threshold of the mean speech
+        # probability and number of frames speech is held after it ends 
+        self.speech_threshold = speech_threshold
+        self.hangover         = hangover
+        self.hang             = np.zeros(B, dtype=int)
+        self.speech           = None
 
         #
         self.store             = {}
-        self.store['Lambda_D'] = np.zeros((nfft/2+1, L_MAX))
-        self.store['p']        = np.zeros((nfft/2+1, L_MAX))
-        self.store['xi']       = np.zeros((nfft/2+1, L_MAX))
-        self.store['MSE']       = np.zeros((nfft/2+1, L_MAX))
+        self.store['Lambda_D'] = np.zeros((nfft/2+1, B, L_MAX))
+        self.store['p']        = np.zeros((nfft/2+1, B, L_MAX))
+        self.store['xi']       = np.zeros((nfft/2+1, B, L_MAX))
+        self.store['MSE']       = np.zeros((nfft/2+1, B, L_MAX))
         self.l                 = 0
 
-        # IMCRA initial background segment (frames) 
-        # Initialization
-        self.imcra = imcra(nfft, IS=IS, Bmin=2.1)
+        # IMCRA initial background segment (frames), can be set per stream
+        # Initialization. Other noise estimators are also stored as imcra
+        if noise is None:
+            noise  = imcra
+        self.imcra = noise(nfft, IS=IS, Bmin=Bmin, B=B, **kwargs)
+        # The JIT compiled back-end implements IMCRA only
+        self.jit   = self.jit and noise is imcra
         self.G     = 1
-        self.p     = np.zeros([nfft/2+1, 1])
+        self.Gamma = 1
+        self.p     = np.zeros([nfft/2+1, B])
 
         # Initial noise estimate
         if Lambda_D is None:
-            self.Lambda_D = 1e-6*np.ones([nfft/2+1, 1])
+            self.Lambda_D = 1e-6*np.ones([nfft/2+1, B])
         else:
             self.Lambda_D = Lambda_D
 
-    def update(self, Y):
+    def update(self, Y, mask=None):
+        '''
+        Enhance STFT frames
 
-        hat_X    = np.zeros(Y.shape, dtype=complex)
-        G        = self.G
-        Gamma    = G
-        Lambda_D = self.Lambda_D 
-        p        = self.p 
-        K, L     = Y.shape
+        Input: Y     [K, L] STFT or [K, B, L] STFTs of the B streams. If a 
+                     single STFT is given for B > 1 it is shared by all
+                     streams, see sweep()
 
-        if self.l + L > L_MAX:
+        Input: mask  [B, L] bool, frames present on each stream, e.g. to
+                     process streams of different lengths. Masked frames
+                     leave their stream untouched and are returned as zero.
+                     Default is all frames present.
 
-            # If maximum size surpassed, add a new batch of zeroes
-            self.store['Lambda_D'] = np.concatenate((self.store['Lambda_D'], 
-                                                     np.zeros((K, L_MAX))), 1) 
-            self.store['p']        = np.concatenate((self.store['p'], 
-                                                     np.zeros((K, L_MAX))), 1)
-            self.store['xi']        = np.concatenate((self.store['xi'], 
-                                                     np.zeros((K, L_MAX))), 1)
-            self.store['MSE']        = np.concatenate((self.store['MSE'], 
-                                                      np.zeros((K, L_MAX))), 1)
+        Output: hat_X [K, L] for B = 1, [K, B, L] otherwise
+        '''
 
+        # Single or shared stream is processed as [K, 1, L]
+        if Y.ndim == 2:
+            Y    = Y[:, None, :]
+        G        = self.G
+        Gamma    = self.Gamma
+        Lambda_D = self.Lambda_D 
+        p        = self.p 
+        K, B, L  = Y.shape[0], self.B, Y.shape[2]
+        hat_X    = np.zeros((K, B, L), dtype=complex)
+        if mask is None:
+            mask = np.ones((B, L), dtype=bool)
+
+        self.reserve(L)
+
+        # JIT compiled back-end, for now only without masked frames
+        if self.jit and np.all(mask):
+            hat_X = self.update_jit(Y)
+            # Speech probability after each frame
+            score = np.concatenate((self.store['p'][:, :, self.l-L+1:self.l],
+                                    self.p[:, :, None]), 2).mean(0)
+            self.detect_speech(score, mask)
+            if B == 1:
+                hat_X = hat_X[:, 0, :]
+            return hat_X
+
+        # Mean speech probability after each frame
+        score = np.zeros((B, L))
         for l in np.arange(0, L):
+
+            # Streams with a frame at this time
+            m = mask[:, l]
         
             # A priori SNR, stationary parameter estimate (uses last Gamma)   
             xi_G              = (G**2)*Gamma
             # A posterori SNR
-            Gamma             = (np.abs(Y[:, l:l+1])**2)/Lambda_D
+            Gamma             = np.where(m, (np.abs(Y[:, :, l])**2)/Lambda_D,
+                                         Gamma)
             # A priori SNR, maximum likelihood estimate 
             xi_ML             = Gamma - 1
             xi_ML[xi_ML<1e-6] = 1e-6      
             # Decision directed rule
             xi                = self.alpha*xi_G + (1-self.alpha)*xi_ML
             # Flooring
-            xi[xi<self.xi_min] = self.xi_min 
+            xi                = np.maximum(xi, self.xi_min)
 
             # MMSE-LSA
             # Get Wiener gain
-            G               = xi/(1 + xi) 
-            hat_X[:, l:l+1] = sip.MMSE_LSA(G*Y[:, l:l+1], G*Lambda_D)
+            G               = np.where(m, xi/(1 + xi), G)
+            Y_l             = np.broadcast_to(Y[:, :, l], (K, B))
+            hat_X[:, m, l]  = sip.MMSE_LSA(G[:, m]*Y_l[:, m], 
+                                           G[:, m]*Lambda_D[:, m])
             # Residual MSE of Wiener filter
             MSE             = G*Lambda_D
         
             # TODO: Store additional variables if solicited
-            self.store['Lambda_D'][:, self.l:self.l+1]  = Lambda_D 
-            self.store['p'][:, self.l:self.l+1]         = p
-            self.store['xi'][:, self.l:self.l+1]        = xi
-            self.store['MSE'][:, self.l:self.l+1]       = MSE 
-            self.l                                     += 1
+            self.store['Lambda_D'][:, m, self.l] = Lambda_D[:, m]
+            self.store['p'][:, m, self.l]        = p[:, m]
+            self.store['xi'][:, m, self.l]       = xi[:, m]
+            self.store['MSE'][:, m, self.l]      = MSE[:, m]
+            self.l                              += 1
+
+            # IMCRA noise estimate and posterior speech probability for the
+            # next iteration. Streams without frame keep their values
+            Lambda_D_l, p_l = self.imcra.update(Y[:, :, l], Gamma, xi, m)
+            Lambda_D        = np.where(m, Lambda_D_l, Lambda_D)
+            p               = np.where(m, p_l, p)
+            score[m, l]     = np.mean(p[:, m], 0)
+
+        # Keep these for the next iteration
+        self.G        = G
+        self.Gamma    = Gamma
+        self.Lambda_D = Lambda_D
+        self.p        = p
+
+        self.detect_speech(score, mask)
+        if B == 1:
+            hat_X = hat_X[:, 0, :]
+
+        return hat_X
+
+    def update_jit(self, Y):
+        '''
+        Same as update() for a [K, B, L] (or shared [K, 1, L]) STFT without
+        masked frames, using the fused kernel of imcra_jit.py
+        '''
+
+        K, B, L = Y.shape[0], self.B, Y.shape[2]
+        imc     = self.imcra
+        # Parameters are passed per stream
+        per_B   = lambda par: np.ones(B)*par
+        # The kernel updates state in place, it needs contiguous arrays 
+        for name in IMCRA_STATE:
+            setattr(imc, name, np.ascontiguousarray(getattr(imc, name)))
+        G        = self.G*np.ones((K, B))
+        Gamma    = self.Gamma*np.ones((K, B))
+        Lambda_D = self.Lambda_D*np.ones((K, B))
+        p        = self.p.copy()
+        # Outputs
+        hat_X    = np.zeros((K, B, L), dtype=complex)
+        st       = dict([(par, np.zeros((K, B, L))) for par in self.store])
+
+        imcra_jit.imcra_se_kernel(np.ascontiguousarray(Y, dtype=complex), 
+                                  per_B(self.alpha), per_B(self.xi_min), G,
+                                  Gamma, Lambda_D, p, hat_X, st['Lambda_D'],
+                                  st['p'], st['xi'], st['MSE'], imc.S,
+                                  imc.Smin, imc.tilde_S, imc.tilde_Smin,
+                                  imc.Smin_sw, imc.tilde_Smin_sw, imc.Storing,
+                                  imc.tilde_Storing, imc.ov_Lambda_D,
+                                  imc.Lambda_D, imc.q, imc.p, imc.l, imc.j,
+                                  imc.u, imc.IS, imc.sm_win, imc.sm_norm[:, 0],
+                                  per_B(imc.alpha_s), per_B(imc.alpha_d),
+                                  per_B(imc.Bmin), per_B(imc.Gamma0),
+                                  per_B(imc.Gamma1), per_B(imc.zeta0),
+                                  per_B(imc.beta), imc.U, imc.V)
+
+        for par in self.store:
+            self.store[par][:, :, self.l:self.l+L] = st[par]
+        self.l += L
+
+        # Keep these for the next iteration
+        self.G        = G
+        self.Gamma    = Gamma
+        self.Lambda_D = Lambda_D
+        self.p        = p
+
+        return hat_X
+
+    def update_offline(self, Y):
+        '''
+        Same as update() but for file based processing. The parts of IMCRA
+        that do not depend on the decision directed rule are computed for the
+        whole [K, L] STFT in one go, see imcra.vad(), only the a priori SNR,
+        speech probability and noise recursions run frame by frame.
+        Single stream only.
+        '''
+
+        # SANITY CHECK: Offline processing is done one stream at a time 
+        if self.B != 1:
+            raise ValueError, "update_offline() supports only B = 1"
+        # SANITY CHECK: Offline processing is only implemented for IMCRA
+        if self.imcra.__class__ is not imcra:
+            raise ValueError, "update_offline() supports only the imcra estimator"
+
+        G        = self.G
+        Gamma    = self.Gamma
+        Lambda_D = self.Lambda_D 
+        p        = self.p 
+        K, L     = Y.shape
+        P        = np.abs(Y)**2
+        G_l      = np.zeros((K, L))
+        score    = np.zeros((1, L))
+        self.reserve(L)
+
+        # Frame index of the first frame, a priori speech absence for all
+        l0 = self.imcra.l[0] + 1
+        q  = self.imcra.vad(Y)
+
+        for l in np.arange(0, L):
+        
+            # A priori SNR, stationary parameter estimate (uses last Gamma)   
+            xi_G              = (G**2)*Gamma
+            # A posterori SNR
+            Gamma             = P[:, l:l+1]/Lambda_D
+            # A priori SNR, maximum likelihood estimate 
+            xi_ML             = Gamma - 1
+            xi_ML[xi_ML<1e-6] = 1e-6      
+            # Decision directed rule
+            xi                = self.alpha*xi_G + (1-self.alpha)*xi_ML
+            # Flooring
+            xi[xi<self.xi_min] = self.xi_min 
+            # Wiener gain
+            G                 = xi/(1 + xi) 
+            G_l[:, l:l+1]     = G
+
+            self.store['Lambda_D'][:, :, self.l] = Lambda_D 
+            self.store['p'][:, :, self.l]        = p
+            self.store['xi'][:, :, self.l]       = xi
+            self.l                              += 1
 
             # IMCRA noise estimate and posterior speech probability for the
             # next iteration
-            Lambda_D, p = self.imcra.update(Y[:, l:l+1], Gamma, xi)
+            Lambda_D, p = self.imcra.noise_update(Y[:, l:l+1], q[:, l:l+1],
+                                                  Gamma, xi, l0 + l)
+            score[0, l] = np.mean(p)
+
+        # MMSE-LSA and residual MSE of Wiener filter for the whole block
+        Lambda_D_l = self.store['Lambda_D'][:, 0, self.l-L:self.l]
+        hat_X      = sip.MMSE_LSA(G_l*Y, G_l*Lambda_D_l)
+        self.store['MSE'][:, 0, self.l-L:self.l] = G_l*Lambda_D_l
 
         # Keep these for the next iteration
         self.G        = G
-        self.Lambda_D = Lambda_D[:, -2:]
+        self.Gamma    = Gamma
+        self.Lambda_D = Lambda_D
         self.p        = p
 
+        self.detect_speech(score, np.ones((1, L), dtype=bool))
+
         return hat_X
 
+    def detect_speech(self, score, mask):
+        '''
+        Frame-level speech mask with hangover. A frame is speech if the mean
+        over bins of its posterior speech probability is above
+        speech_threshold, or if it follows such a frame by at most hangover
+        frames. The hangover count is kept across calls. Does nothing if
+        speech_threshold is not set
+
+        Input: score  [B, L] mean speech probability of each frame
+        Input: mask   [B, L] bool, frames present on each stream
+
+        Sets self.speech [L] bool, [B, L] for B > 1
+        '''
+        if self.speech_threshold is None:
+            return
+
+        active = mask & (score > self.speech_threshold)
+        speech = np.zeros(active.shape, dtype=bool)
+        for l in range(active.shape[1]):
+            # Frames left of hangover, only present frames count
+            self.hang    = np.where(active[:, l], self.hangover + 1,
+                                    np.where(mask[:, l], 
+                                             np.maximum(self.hang - 1, 0),
+                                             self.hang))
+            speech[:, l] = mask[:, l] & (self.hang > 0)
+
+        if self.B == 1:
+            self.speech = speech[0]
+        else:
+            self.speech = speech
+
+    def get_state(self):
+        '''
+        Returns a snapshot of the enhancement state as a flat float array, see
+        imcra.get_state(). The store of past parameters is not included.
+        '''
+        KB = self.p.shape
+        return np.concatenate(((self.G*np.ones(KB)).ravel(),
+                               (self.Gamma*np.ones(KB)).ravel(),
+                               (self.Lambda_D*np.ones(KB)).ravel(),
+                               self.p.ravel(), self.hang, 
+                               self.imcra.get_state()))
+
+    def set_state(self, state):
+        '''
+        Restores a snapshot returned by get_state(). Processing continues
+        exactly as it would have from the moment the snapshot was taken.
+        '''
+        KB = self.p.shape
+        n  = self.p.size
+        self.G        = state[:n].reshape(KB)
+        self.Gamma    = state[n:2*n].reshape(KB)
+        self.Lambda_D = state[2*n:3*n].reshape(KB)
+        self.p        = state[3*n:4*n].reshape(KB)
+        self.hang     = state[4*n:4*n+self.B].astype(int)
+        self.imcra.set_state(state[4*n+self.B:])
+
+    def reserve(self, L):
+        '''
+        Make sure the store has room for L more frames
+        '''
+        K, B = self.store['Lambda_D'].shape[:2]
+        while self.l + L > self.store['Lambda_D'].shape[2]:
+            # If maximum size surpassed, add a new batch of zeroes
+            for par in self.store.keys():
+                self.store[par] = np.concatenate((self.store[par],
+                                                  np.zeros((K, B, L_MAX))), 2)
+
     def get_param(self, param_list):
         '''
-        Return stored parameters
+        Return stored parameters, [K, L] or [K, B, L] for B > 1
         '''
         val_list = []
         for par in param_list:
             if par not in self.store:
                 raise ValueError, "Parameter %s was not recorded" % par
-            val_list.append(self.store[par][:, :self.l]) 
+            if self.B == 1:
+                val_list.append(self.store[par][:, 0, :self.l]) 
+            else:
+                val_list.append(self.store[par][:, :, :self.l]) 
+        return val_list
+
+    def pop_param(self, param_list):
+        '''
+        Same as get_param() but the store is emptied afterwards, so that it
+        does not grow when long streams are processed chunk by chunk. All
+        parameters not in param_list are lost
+        '''
+        val_list = [val.copy() for val in self.get_param(param_list)]
+        self.l   = 0
         return val_list
 
 class imcra():
     '''
     IMCRA class
+
+    Keeps [K, B] buffers so that B independent streams can be advanced in
+    lock-step with each call to update(). Frame counters are kept per
+    stream.
+
+    Bmin is BMIN by default, Bmin='calibrate' computes it for this 
+    configuration and the framing given in windowsize and shift, see
+    calibrate()
     '''
 
-    def __init__(self, nfft, Bmin=None, **kwargs):
+    # Buffers and counters saved by get_state()
+    state = IMCRA_STATE
+
+    def __init__(self, nfft, Bmin=BMIN, B=1, **kwargs):
 
         # IMCRA DEFAULT CONFIGURATION
         # Consult [1] on how to set the parameters
@@ -193,6 +650,10 @@ class imcra():
         self.epsilon            = 0.01
         # Significance level for the second VAD
         self.epsilon1           = 0.05
+        # STFT window and shift in samples of the signal to be processed,
+        # only used to calibrate Bmin. nfft and half of it by default
+        self.windowsize         = None
+        self.shift              = None
 
         # Overload defaults
         for par in kwargs.keys():
@@ -203,9 +664,11 @@ class imcra():
                 raise ValueError,"%s is not an imcra parameter" % par
 
         # If the standard significance levels and smoothing parameters not used
-        # we need to recompute everything
-        if ((self.epsilon == 0.01) & (self.epsilon1 == 0.05)
-            & (self.alpha_s == 0.9) & (self.w == 1)):
+        # we need to recompute everything. Note that alpha_s, epsilon and
+        # epsilon1 can be given per stream
+        default = ((self.epsilon == 0.01) & (self.epsilon1 == 0.05)
+                   & (self.alpha_s == 0.9) & (self.w == 1))
+        if np.all(default):
             # VAD is attained through hypothesis test assuming distributions
             # for ratios related to the minimum statistics, these are the
             # parameteres
@@ -223,145 +686,195 @@ class imcra():
             self.beta            = 1.47
 
         else:
-            # Note: This STILL assumes that we use the posterior probability
-            # as defined by [1, Eq. 7], see [1, App. II]
-            # This will need SCIPY!
-            import scipy.stats.chi2 as chi2
-            # Approx degrees of freedom of Eq. 20, see App. II
-            mu          = (1+self.alpha_s)/(1-self.alha_s)*(1 + 0.7*w)
-            # Treshold to achieve 0.01 significance in first VAD speech absence
-            # hypothesis test
-            self.Gamma0 = -np.log(epsilon)
-            self.zeta0  = chi2.ppf(1-epsilon,mu)/mu
-            self.Gamma1 = -np.log(epsilon1)
-            # Treshold to achieve 0.05 significance in second VAD speech
-            # presence hypothesis test [1, Eq. 31])
-            self.beta   = ((gamma1 - 1 -np.exp(-1) + np.exp(-gamma1))/
-                           (gamma1 -1 - 3*np.exp(-1)
-                            + (gamma1+2)*np.exp(-gamma1)))
-
-        # Check for smoothed spectrogram bias set
+            [self.Gamma0, self.Gamma1, 
+             self.zeta0, self.beta] = thresholds(self.w, self.alpha_s,
+                                                 self.epsilon, self.epsilon1)
+            # Streams with default configuration use the values above
+            if np.any(default):
+                self.Gamma0 = np.where(default, 4.6, self.Gamma0)
+                self.Gamma1 = np.where(default, 3, self.Gamma1)
+                self.zeta0  = np.where(default, 1.67, self.zeta0)
+                self.beta   = np.where(default, 1.47, self.beta)
+
+        # Smoothed spectrogram bias, either given or calibrated for this 
+        # configuration (computed once and cached)
         if Bmin is None:
-            import warnings
-            warnings.warn("Minimum statistic bias Bmin is not set. Run "
-                          "imcra.setBmin(), until then 2.1 used.",
-                          DeprecationWarning)
-            self.Bmin = 2.1   # This is for my config!
+            self.Bmin = BMIN
+        elif isinstance(Bmin, str) and Bmin == 'calibrate':
+            Bmin = [calibrate(nfft, w=self.w, alpha_s=a_s, U=self.U, V=self.V,
+                              epsilon=eps, epsilon1=eps1,
+                              windowsize=self.windowsize, shift=self.shift)[0] 
+                    for a_s, eps, eps1 in np.broadcast(self.alpha_s, 
+                                                       self.epsilon,
+                                                       self.epsilon1)]
+            if np.ndim(default):
+                self.Bmin = np.array(Bmin)
+            else:
+                self.Bmin = Bmin[0]
         else:
             self.Bmin = Bmin
 
         self.K = nfft/2+1     # Number of frequency bins under Nyquist
-        self.l = -1           # Set frame index. -1 is no frame processed
-        self.j = 0            # Set counter for the buffer update
-        self.u = 0            # Set copunter for buffer last filled position
-
-        # To do the smoothing in frequency fast, we create indices to expand
-        # each frame (column) to a matrix with that column on the center and
-        # neighbouring frequencies on each row. Thay way we can smooth with
-        # One single loop
-        # Create matrix of indices
-        self.sm_idx = np.arange(0,self.K)[:,None] + np.arange(-self.w,self.w+1)[None,:]
-        # Create coresponding matrix of hamming windows
-        self.sm_win = np.tile(sym_hanning(2*self.w+1),(self.K,1))
-        # Ignore indices out of bounds
-        self.sm_win[self.sm_idx<0]        = 0
-        self.sm_win[self.sm_idx>self.K-1] = 0
-        self.sm_idx[self.sm_idx<0]        = 0
-        self.sm_idx[self.sm_idx>self.K-1] = self.K-1
-        # Normalize
-        self.sm_win = self.sm_win/np.sum(self.sm_win, 1, keepdims=True)
+        self.B = B            # Number of streams
+        # Counters, one per stream
+        self.l = -np.ones(B, dtype=int)   # Set frame index. -1 is no frame processed
+        self.j = np.zeros(B, dtype=int)   # Set counter for the buffer update
+        self.u = np.zeros(B, dtype=int)   # Set copunter for buffer last filled position
+        # Initial segment can be set per stream
+        self.IS = np.asarray(self.IS)*np.ones(B, dtype=int)
+
+        # Frequency smoothing is a convolution along frequency with a Hanning
+        # window of 2*w+1 taps. Out of bound bins are ignored, so the output
+        # is normalized by the window mass that falls inside the spectrum
+        self.sm_win  = sym_hanning(2*self.w+1)
+        self.sm_norm = scipy.ndimage.correlate1d(np.ones(self.K), self.sm_win,
+                                                 mode='constant')[:, None]
 
         # BUFFERS
-        #  They will be propperly initialized when the first frame is processed
+        #  They will be propperly initialized when the first frame is
+        #  processed. Until then they are set to one so that streams that
+        #  did not start yet do not produce divisions by zero
 
         #  Smoothed Spectrogram first iteration
-        self.S             = np.zeros([self.K, 1])
+        self.S             = np.ones([self.K, B])
         #  Smoothed Spectrogram minimum first iteration
-        self.Smin          = np.zeros([self.K, 1])
+        self.Smin          = np.ones([self.K, B])
         #  Smoothed Spectrogram second iteration
-        self.tilde_S       = np.zeros([self.K, 1])
+        self.tilde_S       = np.ones([self.K, B])
         #   Smoothed Spectrogram second iteration
-        self.tilde_Smin    = np.zeros([self.K, 1])
+        self.tilde_Smin    = np.ones([self.K, B])
         #  Smoothed Spectrogram minimum running minimum
-        self.Smin_sw       = np.zeros([self.K, 1])
+        self.Smin_sw       = np.ones([self.K, B])
         #  Second smoothed Spectrogram minimum running minimum
-        self.tilde_Smin_sw = np.zeros([self.K, 1])
-        #  Smoothed Spectrogram minimum first iteration store buffer
-        self.Storing       = np.zeros([self.K, self.U])
+        self.tilde_Smin_sw = np.ones([self.K, B])
+        #  Smoothed Spectrogram minimum first iteration store buffer. This is
+        #  a circular buffer, unused positions are inf
+        self.Storing       = np.inf*np.ones([self.K, self.U, B])
         #  Smoothed Spectrogram minimum second iteration store buffer
-        self.tilde_Storing = np.zeros([self.K, self.U])
+        self.tilde_Storing = np.inf*np.ones([self.K, self.U, B])
         #  Biased noise variance estimate
-        self.ov_Lambda_D   = np.zeros([self.K, 1])
+        self.ov_Lambda_D   = np.zeros([self.K, B])
         #  Unbiased noise variance estimate
-        self.Lambda_D      = np.zeros([self.K, 1])
+        self.Lambda_D      = np.zeros([self.K, B])
         #  A posteriori speech presence probability
-        self.q             = np.ones([self.K, 1])
+        self.q             = np.ones([self.K, B])
         #  A posteriori speech presence probability
-        self.p             = np.zeros([self.K, 1])
+        self.p             = np.zeros([self.K, B])
 
 
+    def get_state(self):
+        '''
+        Returns a snapshot of the estimator state (buffers and counters in
+        self.state, IMCRA_STATE by default) as a flat float array. The configuration is not
+        included, the snapshot can only be restored with set_state() on an
+        imcra instance with the same nfft, B and parameters.
+        '''
+        return np.concatenate([np.ravel(getattr(self, name)).astype(float)
+                               for name in self.state])
+
+    def set_state(self, state):
+        '''
+        Restores a snapshot returned by get_state()
+        '''
+        # SANITY CHECK: Snapshot matches this configuration
+        sizes = [np.size(getattr(self, name)) for name in self.state]
+        if np.size(state) != sum(sizes):
+            raise ValueError, ("State of size %d does not match this imcra "
+                               "configuration (%d)" % (np.size(state), sum(sizes)))
+        n = 0
+        for name, size in zip(self.state, sizes):
+            buf = getattr(self, name)
+            setattr(self, name, 
+                    state[n:n+size].reshape(buf.shape).astype(buf.dtype))
+            n  += size
+
     def setBmin(self, N):
         '''
         Computes Bmin given the stft of a white noise signal as obtained e.g
 
             n    = np.random.randn(1e5)
             N    = stft(n, windowsize, shift, nfft)
-            Bmin = imcra.computeBmin(N)
+            Bmin = imcra.setBmin(N)
 
+        Bmin is the ratio between the noise variance and the mean of the
+        minimum statistic Smin. The first smoothing and minimum tracking are
+        run over the whole signal in bulk, the first U*V frames, where the
+        minimum store is not yet full, are discarded. See also calibrate()
         '''
         # SANITY CHECK: Enough samples
         if N.shape[1] < 3*self.U*self.V:
             raise ValueError, "Not enough samples, pick a langer white noise signal"
 
-        Bmin = np.zeros(N.shape)
-        for l in np.arange(0,N.shape[1]):
-            # Init
-            if l == 0:
-                self.init_params(N[:,l:l+1])
-
-            # Get minimum statistics
-            Bmin     = (np.abs(N[:,l:l+1])**2)/self.Smin                                          # [3,eq.18]
-            #zeta[:,l:l+1]            = imcra.S/(imcra.Bmin*imcra.Smin)                           # [3,eq.21]
-            #tilde_Gamma_min[:,l:l+1] = (np.abs(Y[:,l:l+1])**2)/(imcra.Bmin*imcra.tilde_Smin)     # [3,eq.18]
-            #tilde_zeta[:,l:l+1]      = imcra.S/(imcra.Bmin*imcra.tilde_Smin)                     # [3,eq.21]
-
-        # Compute mean as average
-        self.Bmin = np.mean(Bmin)
+        P    = np.abs(N)**2
+        K, L = P.shape
+        # Frequency and time smoothing  [3,eqs.14,15]
+        Sf   = self.fsmooth(P)
+        S, _ = scipy.signal.lfilter([1-self.alpha_s], [1, -self.alpha_s], Sf,
+                                    axis=1, zi=self.alpha_s*Sf[:, :1])
+        # Split in blocks of V frames, each ending on a minimum tracking update
+        M    = L/self.V
+        P    = P[:, :M*self.V].reshape(K, M, self.V)
+        S    = S[:, :M*self.V].reshape(K, M, self.V)
+        # Running minimum inside each block
+        Smin_run = np.minimum.accumulate(S, 2)
+        # Stored minima, Smin_sw is reset to S at the end of each block
+        Smin_sw          = Smin_run[:, :, -1].copy()
+        Smin_sw[:, 1:]   = np.minimum(Smin_sw[:, 1:], S[:, :-1, -1])
+        # Minimum of the last U stored values
+        Smin_U           = Smin_sw.copy()
+        for d in range(1, self.U):
+            Smin_U[:, d:] = np.minimum(Smin_U[:, d:], Smin_sw[:, :-d])
+        # Minimum statistic at each frame of the blocks with a full store
+        Smin = np.minimum(Smin_U[:, self.U-1:-1, None], Smin_run[:, self.U:, :])
+
+        self.Bmin = np.mean(P[:, self.U:, :])/np.mean(Smin)
 
         return self.Bmin
 
-    '''
-    Fast frequency smoothing
-    '''
     def fsmooth(self, P_l):
-        return np.sum(self.sm_win*P_l[self.sm_idx][:, :, 0], 1)[:,None]
+        '''
+        Fast frequency smoothing of a [K, 1] frame or a [K, L] block
+        '''
+        return (scipy.ndimage.correlate1d(P_l, self.sm_win, axis=0,
+                                          mode='constant')/self.sm_norm)
 
-    def init_params(self,Y_l):
+    def init_params(self, Y_l, cols=None):
+        '''
+        Initialize buffers with the first observed frame
+
+        Input: Y_l   [K, B] STFT frame, [K, 1] if shared by all streams
+        Input: cols  [B] bool, streams to initialize (default all)
+        '''
+
+        if cols is None:
+            cols = np.ones(self.B, dtype=bool)
+        P  = np.broadcast_to(np.abs(Y_l)**2, (self.K, self.B))[:, cols]
+        Sf = self.fsmooth(P)
 
         #  Smoothed spectrograms
 
         #  Smoothed Spectrogram first iteration
-        self.S             = self.fsmooth(np.abs(Y_l)**2)
+        self.S[:, cols]             = Sf
         #  Smoothed Spectrogram second iteration
-        self.tilde_S       = self.S.copy()
+        self.tilde_S[:, cols]       = Sf
         #  Smoothed Spectrogram minimum first iteration
-        self.Smin          = self.S.copy()
+        self.Smin[:, cols]          = Sf
         #  Smoothed Spectrogram minimum first second iteration
-        self.tilde_Smin    = self.S.copy()
+        self.tilde_Smin[:, cols]    = Sf
         #  Smoothed Spectrogram minimum running minimum
-        self.Smin_sw       = self.S.copy()
+        self.Smin_sw[:, cols]       = Sf
         #  Second smoothed Spectrogram minimum running minimum
-        self.tilde_Smin_sw = self.S.copy()
+        self.tilde_Smin_sw[:, cols] = Sf
         #  Other parameters
 
         #  Biased noise variance estimate
-        self.ov_Lambda_D   = np.abs(Y_l)**2
+        self.ov_Lambda_D[:, cols]   = P
         #  Unbiased noise variance estimate
-        self.Lambda_D      = self.ov_Lambda_D
+        self.Lambda_D[:, cols]      = P
         #  A posteriori speech presence probability
-        self.p             = np.ones(Y_l.shape)
+        self.p[:, cols]             = 1
 
-    def update(self, Y_l, Gamma, xi):
+    def update(self, Y_l, Gamma, xi, mask=None):
 
         '''
         This calls the components of IMCRA as in the original paper. These are
@@ -371,48 +884,33 @@ class imcra():
         Probabilistic recursive smoothing
     
         For the initialization period (only noise assumed) it uses normal smoothing
+
+        Input: Y_l   [K, B] STFT frame of each stream, [K, 1] if shared by 
+                     all streams, see sweep()
+        Input: Gamma [K, B] A posteriori SNR 
+        Input: xi    [K, B] A priori SNR
+        Input: mask  [B] bool, streams that have a frame at this time. The
+                     others are left untouched (default all)
         '''
 
-        # Increase frame counter
-        self.l += 1
+        if mask is None:
+            mask = np.ones(self.B, dtype=bool)
 
-        # If in first frame, initialize buffers with observed frame
-        if self.l == 0:
-            self.init_params(Y_l)
+        # Counters, smoothing and running minimum
+        [in_IS, in_SP] = self.smooth(Y_l, mask)
 
-        # If in initialization segment, update noise stats only
-        # Note: Keep in mind that IS might be zero
-        if self.l < self.IS:
+        # Set a priori background probability to one
+        self.q[:, in_IS] = 1
 
-            # Frequency smoothing  [3,eq.14]
-            Sf            = self.fsmooth(np.abs(Y_l)**2)                                         
-            # Frequency and time smoothing  [3,eqs.15]
-            self.S        = self.alpha_s*self.S + (1-self.alpha_s)*Sf                 
-            # Update running minimum
-            self.Smin     = np.min(np.concatenate((self.Smin,self.S),1),1)[:,None]
-            self.Smin_sw  = np.min(np.concatenate((self.Smin_sw,self.S),1),1)[:,None]
-            # Compute smoothed spectrogram for p = 0
-            self.Lambda_D = self.alpha_d*self.Lambda_D + (1-self.alpha_d)*np.abs(Y_l)**2
-            # Set a priori background probability to one
-            self.q[:]     = 1
-            # Set a posteriori speech probability to zero
-            self.p[:]     = 0
-
-        else:
+        if np.any(in_SP):
 
             # FIRST MINIMA CONTROLLED VAD
             # This provides a rough VAD to eliminate relatively strong speech
             # components towards the second power spectrum estimation
-            Sf           = self.fsmooth(np.abs(Y_l)**2)                                         # [3,eq.14]
-            # Time smoothing
-            self.S       = self.alpha_s*self.S+(1-self.alpha_s)*Sf                    # [3,eq.15]
-            # update running minimum
-            self.Smin     = np.min(np.concatenate((self.Smin,self.S),1),1)[:,None]
-            self.Smin_sw  = np.min(np.concatenate((self.Smin_sw,self.S),1),1)[:,None]
             # Indicator function for VAD
             Gamma_min     = (np.abs(Y_l)**2)/(self.Bmin*self.Smin)                    # [3,eq.18]
             zeta          = self.S/(self.Bmin*self.Smin)                             # [3,eq.21]
-            I             = np.zeros([self.K, 1])
+            I             = np.zeros(self.S.shape)
             I[(Gamma_min < self.Gamma0 ) & (zeta < self.zeta0)] = 1                   # [3,eq.21]
 
             # SECOND MINIMA CONTROLLED VAD
@@ -422,62 +920,532 @@ class imcra():
             norm                  = self.fsmooth(I)
             self.tilde_Sf         = self.fsmooth(I*np.abs(Y_l)**2)
             self.tilde_Sf[norm>0] = self.tilde_Sf[norm>0]/norm[norm>0]
-            # Time smoothing
-            self.tilde_S       = self.alpha_s*self.tilde_S+(1-self.alpha_s)*self.tilde_Sf                 # [3,eq.27]
+            # Time smoothing. Bins without any neighbour free of speech keep
+            # their last value [3,eq.26]
+            self.tilde_S       = np.where(in_SP & (norm>0), self.alpha_s*self.tilde_S+(1-self.alpha_s)*self.tilde_Sf,
+                                          self.tilde_S)                                                 # [3,eq.27]
             # Update running minimum
-            self.tilde_Smin     = np.min(np.concatenate((self.tilde_Smin,self.tilde_S),1),1)[:,None]      # [3,eq.26]
-            self.tilde_Smin_sw  = np.min(np.concatenate((self.tilde_Smin_sw,self.tilde_S),1),1)[:,None]   # [3,eq.27]
+            self.tilde_Smin     = np.where(in_SP, np.minimum(self.tilde_Smin, self.tilde_S), 
+                                           self.tilde_Smin)                                             # [3,eq.26]
+            self.tilde_Smin_sw  = np.where(in_SP, np.minimum(self.tilde_Smin_sw, self.tilde_S), 
+                                           self.tilde_Smin_sw)                                          # [3,eq.27]
             # A PRIORI SPEECH ABSENCE
             tilde_Gamma_min  = (np.abs(Y_l)**2)/(self.Bmin*self.tilde_Smin)
             tilde_zeta       = self.S/(self.Bmin*self.tilde_Smin)                      # [3,eq.28]
-            # Speech absence
-            self.q                                                     = np.zeros(Y_l.shape)
-            self.q[(tilde_Gamma_min <= 1) & (tilde_zeta < self.zeta0)] = 1                        # [3,eq.29]
-            self.q[(1 < tilde_Gamma_min) & (tilde_Gamma_min < self.Gamma1) & (tilde_zeta < self.zeta0)] = (self.Gamma1 - tilde_Gamma_min[(1 < tilde_Gamma_min) & (tilde_Gamma_min < self.Gamma1) & (tilde_zeta < self.zeta0)])/(self.Gamma1-1)  # [3,Eq.29]
+            self.q           = np.where(in_SP, 
+                                        self.speech_absence(tilde_Gamma_min, tilde_zeta),
+                                        self.q)
+
+            # UPDATE MINIMUM TRACKING
+            self.j[in_SP] += 1
+            if np.any(in_SP & (self.j == self.V)):
+                self.min_track(in_SP & (self.j == self.V))
+
+        # Noise estimate and posterior speech probability
+        return self.noise_update(Y_l, self.q, Gamma, xi, self.l, mask)
+
+    def smooth(self, Y_l, mask):
+        '''
+        Frame counters, initialization on the first frame and first
+        smoothing and running minimum of the spectrogram. This is shared by
+        all estimators derived from this class.
+
+        Input: Y_l   [K, B] STFT frame, [K, 1] if shared by all streams
+        Input: mask  [B] bool, streams that have a frame at this time
+
+        Output: [in_IS, in_SP] [B] bool, streams in the initialization 
+                segment and after it
+        '''
+
+        # Increase frame counter
+        self.l[mask] += 1
+
+        # If in first frame, initialize buffers with observed frame
+        first = mask & (self.l == 0)
+        if np.any(first):
+            self.init_params(Y_l, first)
+
+        # Streams in initialization segment update noise stats only
+        # Note: Keep in mind that IS might be zero
+        in_IS = mask & (self.l < self.IS)
+        in_SP = mask & (self.l >= self.IS)
+
+        # Frequency smoothing  [3,eq.14]
+        Sf            = self.fsmooth(np.abs(Y_l)**2)                                         
+        # Frequency and time smoothing  [3,eqs.15]
+        self.S        = np.where(mask, self.alpha_s*self.S + (1-self.alpha_s)*Sf,
+                                 self.S)
+        # Update running minimum
+        self.Smin     = np.where(mask, np.minimum(self.Smin, self.S), self.Smin)
+        self.Smin_sw  = np.where(mask, np.minimum(self.Smin_sw, self.S), 
+                                 self.Smin_sw)
+
+        return [in_IS, in_SP]
+
+    def init_noise(self, Y_l, in_IS):
+        '''
+        Noise estimate in the initialization segment, where only noise is
+        assumed: plain recursive smoothing and speech probability zero
+
+        Input: Y_l   [K, B] STFT frame
+        Input: in_IS [B] bool, streams in the initialization segment
+        '''
+        # Compute smoothed spectrogram for p = 0
+        self.Lambda_D = np.where(in_IS, 
+                                 self.alpha_d*self.Lambda_D + (1-self.alpha_d)*np.abs(Y_l)**2,
+                                 self.Lambda_D)
+        # Set a posteriori speech probability to zero
+        self.p        = np.where(in_IS, 0, self.p)
+
+    def speech_absence(self, tilde_Gamma_min, tilde_zeta):
+        '''
+        A priori speech absence probability from the second VAD ratios
+
+        Input: tilde_Gamma_min [K, L] A posteriori SNR w.r.t. tilde_Smin
+        Input: tilde_zeta      [K, L] Smoothed SNR w.r.t. tilde_Smin
+        '''
+        q = np.zeros(tilde_Gamma_min.shape)
+        q[(tilde_Gamma_min <= 1) & (tilde_zeta < self.zeta0)] = 1                        # [3,eq.29]
+        Gamma1 = np.broadcast_to(self.Gamma1, q.shape)
+        idx    = ((1 < tilde_Gamma_min) & (tilde_Gamma_min < Gamma1)
+                  & (tilde_zeta < self.zeta0))
+        q[idx] = (Gamma1[idx] - tilde_Gamma_min[idx])/(Gamma1[idx]-1)          # [3,Eq.29]
+        return q
+
+    def noise_update(self, Y_l, q, Gamma, xi, l, mask=None):
+        '''
+        Recursive part of IMCRA: posterior speech probability and probability
+        driven recursive smoothing of the noise for frame l. Unlike the rest
+        of IMCRA it depends on the a priori SNR, so it has to run frame by
+        frame.
+
+        Input: Y_l   [K, B] STFT frame
+        Input: q     [K, B] a priori speech absence for this frame
+        Input: Gamma [K, B] A posteriori SNR 
+        Input: xi    [K, B] A priori SNR
+        Input: l     int or [B] int frame index 
+        Input: mask  [B] bool, streams to update (default all)
+        '''
+
+        if mask is None:
+            mask = np.ones(self.B, dtype=bool)
+
+        # In the initialization segment, noise only is assumed
+        in_IS = mask & (l < self.IS)
+        in_SP = mask & (l >= self.IS)
+
+        if np.any(in_IS):
+            self.init_noise(Y_l, in_IS)
+
+        if np.any(in_SP):
 
             # A POSTERIORI SPEECH PROBABILITY
-            self.p           = post_speech_prob(Y_l,self.q,Gamma,xi)
+            self.p           = np.where(in_SP, post_speech_prob(Y_l,q,Gamma,xi),
+                                        self.p)
 
             # PROBABILITY DRIVEN RECURSIVE SMOOTHING
             # Smoothing parameter
             tilde_alpha_d    = self.alpha_d+(1-self.alpha_d)*self.p                                     # [3,eq.11]
             # UPDATE NOISE SPECTRUM ESTIMATE
-            self.ov_Lambda_D = tilde_alpha_d*self.ov_Lambda_D + (1-tilde_alpha_d)*np.abs(Y_l)**2     # [3,eq.10]
+            self.ov_Lambda_D = np.where(in_SP, 
+                                        tilde_alpha_d*self.ov_Lambda_D + (1-tilde_alpha_d)*np.abs(Y_l)**2,
+                                        self.ov_Lambda_D)                                               # [3,eq.10]
             # Bias correction
-            self.Lambda_D    = self.beta*self.ov_Lambda_D                                             # [3,eq.12]
+            self.Lambda_D    = np.where(in_SP, self.beta*self.ov_Lambda_D,
+                                        self.Lambda_D)                                                  # [3,eq.12]
+
+        return [self.Lambda_D, self.p]
+
+    def min_track(self, cols):
+        '''
+        Minimum tracking, called every V frames. Stores the last running
+        minima and resets Smin to the minimum of the last U stored values
+
+        Input: cols  [B] bool, streams to update
+        '''
+
+        b    = np.nonzero(cols)[0]
+        # Position in the circular buffer
+        slot = self.u[b] % self.U
+
+        # Minimum tracking for the first estimation
+        self.Storing[:, slot, b] = self.Smin_sw[:, b]
+        # Set Smin to minimum
+        self.Smin[:, b]          = np.min(self.Storing[:, :, b], 1)
+        # Let Smin_sw = S
+        self.Smin_sw[:, b]       = self.S[:, b]
+
+        # Minimum traking for the second estimation
+        self.tilde_Storing[:, slot, b] = self.tilde_Smin_sw[:, b]
+        # Set Smin to minimum
+        self.tilde_Smin[:, b]          = np.min(self.tilde_Storing[:, :, b], 1)
+        # Let Smin_sw = tilde_S
+        self.tilde_Smin_sw[:, b]       = self.tilde_S[:, b]
+        # reset counter
+        self.j[b]  = 0
+        # Increase counter of buffers
+        self.u[b] += 1
+
+    def vad(self, Y):
+        '''
+        Offline version of the parts of IMCRA that do not depend on the a
+        priori SNR: frequency and time smoothing, minimum tracking and both
+        minima controlled VADs. These are computed for a whole [K, L] block
+        with vectorized filters and cumulative minima, looping only over the
+        minimum tracking updates (every V frames). The noise estimate is left
+        untouched, see noise_update()
+
+        Input:  Y  [K, L] STFT of a single stream (B = 1)
+        Output: q  [K, L] a priori speech absence probability
+        '''
+
+        # SANITY CHECK: Single stream
+        if self.B != 1:
+            raise ValueError, "vad() supports only B = 1"
+
+        # If in first frame, initialize buffers with observed frame
+        if self.l[0] == -1:
+            self.init_params(Y[:, :1])
+
+        K, L = Y.shape
+        P    = np.abs(Y)**2
+        q    = np.ones([K, L])
+        # Frequency and time smoothing  [3,eqs.14,15]
+        S, _ = scipy.signal.lfilter([1-self.alpha_s], [1, -self.alpha_s],
+                                    self.fsmooth(P), axis=1,
+                                    zi=self.alpha_s*self.S)
+
+        # Split the block into the initialization segment and segments ending
+        # on minimum tracking updates
+        n_IS   = min(max(self.IS[0] - self.l[0] - 1, 0), L)
+        bounds = [0, n_IS] + range(n_IS + self.V - self.j[0], L, self.V) + [L]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if a == b:
+                continue
+
+            # Update running minima
+            Smin         = np.minimum.accumulate(
+                               np.concatenate((self.Smin, S[:, a:b]), 1), 1)[:, 1:]
+            Smin_sw      = np.minimum.accumulate(
+                               np.concatenate((self.Smin_sw, S[:, a:b]), 1), 1)[:, 1:]
+            self.S       = S[:, b-1:b]
+            self.Smin    = Smin[:, -1:]
+            self.Smin_sw = Smin_sw[:, -1:]
+
+            # In initialization segment, only the first smoothing is updated
+            if b <= n_IS:
+                continue
+
+            # FIRST MINIMA CONTROLLED VAD
+            Gamma_min = P[:, a:b]/(self.Bmin*Smin)                          # [3,eq.18]
+            zeta      = S[:, a:b]/(self.Bmin*Smin)                          # [3,eq.21]
+            I         = np.zeros([K, b-a])
+            I[(Gamma_min < self.Gamma0 ) & (zeta < self.zeta0)] = 1         # [3,eq.21]
+
+            # SECOND MINIMA CONTROLLED VAD
+            norm                = self.fsmooth(I)
+            tilde_Sf            = self.fsmooth(I*P[:, a:b])
+            tilde_Sf[norm>0]    = tilde_Sf[norm>0]/norm[norm>0]
+            # Time smoothing
+            if np.all(norm>0):
+                tilde_S, _      = scipy.signal.lfilter([1-self.alpha_s],
+                                                       [1, -self.alpha_s],
+                                                       tilde_Sf, axis=1,
+                                                       zi=self.alpha_s*self.tilde_S)   # [3,eq.27]
+            else:
+                # Bins without any neighbour free of speech keep their last
+                # value [3,eq.26], this needs a frame by frame recursion
+                tilde_S         = np.zeros([K, b-a])
+                last_S          = self.tilde_S
+                for n in range(b-a):
+                    last_S        = np.where(norm[:, n:n+1]>0, 
+                                             self.alpha_s*last_S + (1-self.alpha_s)*tilde_Sf[:, n:n+1],
+                                             last_S)                                    # [3,eq.27]
+                    tilde_S[:, n] = last_S[:, 0]
+            # Update running minimum
+            tilde_Smin          = np.minimum.accumulate(
+                np.concatenate((self.tilde_Smin, tilde_S), 1), 1)[:, 1:]             # [3,eq.26]
+            tilde_Smin_sw       = np.minimum.accumulate(
+                np.concatenate((self.tilde_Smin_sw, tilde_S), 1), 1)[:, 1:]          # [3,eq.27]
+            self.tilde_S        = tilde_S[:, -1:]
+            self.tilde_Smin     = tilde_Smin[:, -1:]
+            self.tilde_Smin_sw  = tilde_Smin_sw[:, -1:]
+            # A PRIORI SPEECH ABSENCE
+            tilde_Gamma_min     = P[:, a:b]/(self.Bmin*tilde_Smin)
+            tilde_zeta          = S[:, a:b]/(self.Bmin*tilde_Smin)                      # [3,eq.28]
+            q[:, a:b]           = self.speech_absence(tilde_Gamma_min, tilde_zeta)
 
             # UPDATE MINIMUM TRACKING
-            self.j += 1
-            if self.j == self.V:
-
-                # Minimum tracking for the first estimation
-                if self.u < self.U:
-                    self.Storing[:,self.u:self.u+1] = self.Smin_sw
-
-                else:
-                    self.Storing                    = np.roll(self.Storing,-1,axis=1)
-                    self.Storing[:,-1:]             = self.Smin_sw
-
-                # Set Smin to minimum
-                self.Smin = np.min(self.Storing[:,:self.u+1],1)[:,None]
-                # Let Smin_sw = S
-                self.Smin_sw = self.S
-
-                # Minimum traking for the second estimation
-                if self.u < self.U:
-                    self.tilde_Storing[:,self.u:self.u+1] = self.tilde_Smin_sw
-                else:
-                    self.tilde_Storing                    = np.roll(self.tilde_Storing,-1,axis=1)
-                    self.tilde_Storing[:,-1:]             = self.tilde_Smin_sw
-
-                # Set Smin to minimum
-                self.tilde_Smin    = np.min(self.tilde_Storing[:,:self.u+1],1)[:,None]
-                # Let Smin_sw = tilde_S
-                self.tilde_Smin_sw = self.tilde_S
-                # reset counter
-                self.j = 0
-                # Increase counter of buffers
-                self.u                 += 1
+            self.j += b - a
+            if self.j[0] == self.V:
+                self.min_track(self.j == self.V)
+
+        self.l += L
+        self.q  = q[:, -1:].copy()
 
+        return q
+
+
+class minstat(imcra):
+    '''
+    Minimum statistics noise estimator. The noise is the minimum of the
+    smoothed spectrogram over the last U*V frames times the bias Bmin, see
+    [2]. Unlike [2] the smoothing factor is fixed and the minimum is tracked
+    as in IMCRA, so that Bmin can be calibrated the same way. 
+
+    Only the first stage of IMCRA is computed. The speech probability is the
+    complement of the first VAD indicator of IMCRA [3,eq.21].
+    '''
+
+    def update(self, Y_l, Gamma, xi, mask=None):
+        '''
+        Same interface as imcra.update()
+        '''
+
+        if mask is None:
+            mask = np.ones(self.B, dtype=bool)
+
+        # Counters, smoothing and running minimum
+        [in_IS, in_SP] = self.smooth(Y_l, mask)
+
+        if np.any(in_IS):
+            self.init_noise(Y_l, in_IS)
+
+        if np.any(in_SP):
+
+            # Speech probability from hard VAD
+            Gamma_min     = (np.abs(Y_l)**2)/(self.Bmin*self.Smin)                    # [3,eq.18]
+            zeta          = self.S/(self.Bmin*self.Smin)                             # [3,eq.21]
+            I             = (Gamma_min < self.Gamma0) & (zeta < self.zeta0)
+            self.p        = np.where(in_SP, 1. - I, self.p)
+            # Bias compensated minimum
+            self.Lambda_D = np.where(in_SP, self.Bmin*self.Smin, self.Lambda_D)
+
+            # UPDATE MINIMUM TRACKING
+            self.j[in_SP] += 1
+            if np.any(in_SP & (self.j == self.V)):
+                self.min_track(in_SP & (self.j == self.V))
 
         return [self.Lambda_D, self.p]
+
+
+class mcra(imcra):
+    '''
+    Minima Controlled Recursive Averaging [4]. Speech presence is decided by
+    thresholding the ratio of the smoothed spectrogram and its minimum, its
+    recursive average is the speech probability that drives the noise
+    smoothing. Single minimum tracker and no second VAD.
+    '''
+
+    def __init__(self, nfft, Bmin=BMIN, B=1, delta=5, alpha_p=0.2, **kwargs):
+
+        imcra.__init__(self, nfft, Bmin=Bmin, B=B, **kwargs)
+        # Threshold of the ratio S/Smin for speech presence [4,eq.13]
+        self.delta   = delta
+        # Smoothing factor of the speech probability [4,eq.14]
+        self.alpha_p = alpha_p
+
+    def update(self, Y_l, Gamma, xi, mask=None):
+        '''
+        Same interface as imcra.update()
+        '''
+
+        if mask is None:
+            mask = np.ones(self.B, dtype=bool)
+
+        # Counters, smoothing and running minimum
+        [in_IS, in_SP] = self.smooth(Y_l, mask)
+
+        if np.any(in_IS):
+            self.init_noise(Y_l, in_IS)
+
+        if np.any(in_SP):
+
+            # Speech presence indicator and its recursive average
+            I                = self.S/self.Smin > self.delta                       # [4,eq.13]
+            self.p           = np.where(in_SP, self.alpha_p*self.p 
+                                        + (1-self.alpha_p)*I, self.p)              # [4,eq.14]
+            # PROBABILITY DRIVEN RECURSIVE SMOOTHING
+            tilde_alpha_d    = self.alpha_d+(1-self.alpha_d)*self.p               # [4,eq.15]
+            self.Lambda_D    = np.where(in_SP, 
+                                        tilde_alpha_d*self.Lambda_D + (1-tilde_alpha_d)*np.abs(Y_l)**2,
+                                        self.Lambda_D)                             # [4,eq.5]
+
+            # UPDATE MINIMUM TRACKING
+            self.j[in_SP] += 1
+            if np.any(in_SP & (self.j == self.V)):
+                self.min_track(in_SP & (self.j == self.V))
+
+        return [self.Lambda_D, self.p]
+
+
+class spp(imcra):
+    '''
+    Speech presence probability based noise tracker [5]. The posterior speech
+    probability is computed with a fixed a priori SNR and prior and used to
+    get the MMSE estimate of the noise periodogram, which is then smoothed.
+    No spectrogram smoothing or minimum tracking at all, Bmin is not used.
+    '''
+
+    # bar_p, the smoothed speech probability, is also part of the state
+    state = IMCRA_STATE + ['bar_p']
+
+    def __init__(self, nfft, Bmin=1., B=1, xi_H1=10**(15./10), alpha_pow=0.8,
+                 alpha_p=0.9, p_max=0.99, **kwargs):
+
+        # Bmin is accepted for interface compatibility only, it is never
+        # calibrated
+        imcra.__init__(self, nfft, Bmin=1., B=B, **kwargs)
+        # Fixed a priori SNR under speech presence [5,Sec.IV]
+        self.xi_H1     = xi_H1
+        # Smoothing factor of the noise periodogram [5,eq.8]
+        self.alpha_pow = alpha_pow
+        # Smoothing factor and limit of the speech probability to avoid
+        # stagnation [5,Sec.IV-C]
+        self.alpha_p   = alpha_p
+        self.p_max     = p_max
+        self.bar_p     = np.zeros([self.K, B])
+        # Set to one until the first frame, as the other buffers
+        self.Lambda_D  = np.ones([self.K, B])
+
+    def update(self, Y_l, Gamma, xi, mask=None):
+        '''
+        Same interface as imcra.update(). Gamma and xi are not used
+        '''
+
+        if mask is None:
+            mask = np.ones(self.B, dtype=bool)
+
+        # Increase frame counter
+        self.l[mask] += 1
+        # If in first frame, initialize noise with observed frame
+        first = mask & (self.l == 0)
+        if np.any(first):
+            P = np.broadcast_to(np.abs(Y_l)**2, (self.K, self.B))
+            self.Lambda_D = np.where(first, P, self.Lambda_D)
+        in_IS = mask & (self.l < self.IS)
+        in_SP = mask & (self.l >= self.IS)
+
+        if np.any(in_IS):
+            self.init_noise(Y_l, in_IS)
+
+        if np.any(in_SP):
+
+            # A POSTERIORI SPEECH PROBABILITY, equal priors
+            P          = np.abs(Y_l)**2
+            p          = 1./(1 + (1 + self.xi_H1)
+                             *np.exp(-P/self.Lambda_D*self.xi_H1/(1 + self.xi_H1)))  # [5,eq.18]
+            # Avoid stagnation
+            self.bar_p = np.where(in_SP, self.alpha_p*self.bar_p 
+                                  + (1-self.alpha_p)*p, self.bar_p)
+            p          = np.where(self.bar_p > self.p_max, 
+                                  np.minimum(p, self.p_max), p)
+            self.p     = np.where(in_SP, p, self.p)
+            # MMSE noise periodogram and its recursive smoothing
+            N2            = (1-self.p)*P + self.p*self.Lambda_D                  # [5,eq.22]
+            self.Lambda_D = np.where(in_SP, self.alpha_pow*self.Lambda_D 
+                                     + (1-self.alpha_pow)*N2, self.Lambda_D)     # [5,eq.8]
+
+        return [self.Lambda_D, self.p]
+
+
+def benchmark(nfft=512, L=2000, B=1, repeat=3):
+    '''
+    Prints the cost per frame of imcra.update() and of the lower complexity
+    estimators on a white noise STFT 
+
+    Input: nfft   FFT size
+    Input: L      number of frames
+    Input: B      number of streams
+    Input: repeat the best of this number of runs is reported
+    '''
+    import time
+    K     = nfft/2 + 1
+    rs    = np.random.RandomState(0)
+    Y     = rs.randn(K, B, L) + 1j*rs.randn(K, B, L)
+    Gamma = np.ones((K, B))
+    xi    = np.ones((K, B))
+    for noise in [imcra, minstat, mcra, spp]:
+        best = np.inf
+        for r in range(repeat):
+            est = noise(nfft, Bmin=2.1, B=B)
+            t0  = time.time()
+            for l in range(L):
+                est.update(Y[:, :, l], Gamma, xi)
+            best = min(best, time.time() - t0)
+        print "%-8s %8.1f us/frame" % (noise.__name__, 1e6*best/L)
+
+def parity(nfft=512, L=300, B=3):
+    '''
+    Checks that the JIT compiled back-end of imcra_se gives the same output
+    as the NumPy one for a single stream, B streams sharing a STFT and B
+    streams with their own STFT, first with masked frames (NumPy path for
+    both) and then without (JIT path), so that the state is handed over
+    between both. Does nothing if Numba is not installed.
+
+    Input: nfft   FFT size
+    Input: L      number of frames of each chunk
+    Input: B      number of streams
+    '''
+    if not imcra_jit.HAVE_NUMBA:
+        print "Numba not installed, parity check skipped"
+        return
+    K    = nfft/2 + 1
+    rs   = np.random.RandomState(0)
+    # White noise with a louder segment
+    gain = np.ones(2*L)
+    gain[L/2:L] = 5
+    Y    = (rs.randn(K, B, 2*L) + 1j*rs.randn(K, B, 2*L))*gain
+    mask = rs.rand(B, L) > 0.1
+    for name, b, Y_b in [('B=1', 1, Y[:, 0, :]), 
+                         ('B=%d shared' % B, B, Y[:, :1, :]),
+                         ('B=%d' % B, B, Y)]:
+        out = []
+        for jit in [False, True]:
+            se    = imcra_se(nfft, B=b, jit=jit, speech_threshold=0.5)
+            hat_X = [se.update(Y_b[..., :L], mask=mask[:b]), 
+                     se.update(Y_b[..., L:])]
+            out.append(hat_X + se.get_param(['Lambda_D', 'p', 'xi', 'MSE'])
+                       + [se.speech])
+        # SANITY CHECK: Both back-ends match
+        for x_np, x_jit in zip(*out):
+            assert np.allclose(x_np, x_jit), "JIT output differs for %s" % name
+        print "%-12s JIT and NumPy outputs match" % name
+
+def recovery(nfft=512, threshold=0.5):
+    '''
+    Regression check of the second VAD in bins without any neighbour free
+    of speech [3,eq.26]. Three 0.7 s noise bursts in white noise must give 
+    three speech segments on the NumPy, JIT and offline paths, i.e. the
+    speech probability must drop again after each burst.
+
+    Input: nfft       FFT size
+    Input: threshold  speech_threshold of imcra_se
+    '''
+    rs    = np.random.RandomState(3)
+    fs    = 16000
+    n     = np.arange(6*fs)
+    x     = rs.randn(len(n))
+    for start in [1, 3, 5]:
+        burst    = (n >= start*fs) & (n < (start + 0.7)*fs)
+        x[burst] += 3*rs.randn(burst.sum())*(1 + np.sin(8*np.pi*n[burst]/fs))
+    Y     = sip.stft(x, 400, 160, nfft)
+    for name, jit, offline in [('NumPy', False, False), ('JIT', True, False),
+                               ('offline', False, True)]:
+        se = imcra_se(nfft, jit=jit, speech_threshold=threshold)
+        if offline:
+            se.update_offline(Y)
+        else:
+            se.update(Y)
+        segs = sip.segments(se.speech)
+        # SANITY CHECK: One segment per burst
+        assert len(segs) == 3, ("%s: %d speech segments, expected 3" 
+                                % (name, len(segs)))
+        print "%-8s speech segments %s" % (name, 
+                                         ' '.join(['%d-%d' % tuple(seg) 
+                                                   for seg in segs]))
+
+if __name__ == '__main__':
+    parity()
+    recovery()
+    benchmark()
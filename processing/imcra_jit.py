@@ -0,0 +1,220 @@
+'''
+Optional JIT compiled back-end for IMCRA speech enhancement. The per-frame
+recursion of imcra_se.update() and imcra.update() (decision directed a priori
+SNR, MMSE-LSA, IMCRA smoothing, VADs, minimum tracking and noise update) is
+fused into a single loop over frames, streams and bins.
+
+Needs Numba. If it is not installed HAVE_NUMBA is False, the functions below
+stay plain (slow) Python and imcra_se uses the NumPy path instead.
+
+Ramon F. Astudillo
+'''
+
+import math
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+    jit        = numba.njit(cache=True)
+except ImportError:
+    HAVE_NUMBA = False
+    def jit(f):
+        return f
+
+
+@jit
+def fsmooth(x, win, norm, out):
+    '''
+    Frequency smoothing of a [K] frame, same as imcra.fsmooth()
+    '''
+    K = x.shape[0]
+    w = (win.shape[0] - 1)//2
+    for k in range(K):
+        acc = 0.
+        for d in range(max(-w, -k), min(w, K-1-k) + 1):
+            acc += win[d+w]*x[k+d]
+        out[k] = acc/norm[k]
+
+
+@jit
+def MMSE_LSA(mu_XcY, Lambda_XcY):
+    '''
+    Scalar version of signal.MMSE_LSA() including its expint approximation
+    '''
+    nu = abs(mu_XcY)**2/Lambda_XcY
+    if nu < 0.1:
+        expi = -2.31*np.log10(nu) - 0.6
+    elif nu > 0.1:
+        expi = 10**(-0.52*nu - 0.26)
+    elif nu == 0.1:
+        expi = -1.544*np.log10(nu) + 0.166
+    else:
+        expi = 0.
+    return mu_XcY*math.exp(0.5*expi)
+
+
+@jit
+def imcra_se_kernel(Y, alpha, xi_min, G, Gamma, Lambda_D, p,
+                    hat_X, st_Lambda_D, st_p, st_xi, st_MSE,
+                    S, Smin, tilde_S, tilde_Smin, Smin_sw, tilde_Smin_sw,
+                    Storing, tilde_Storing, ov_Lambda_D, imcra_Lambda_D, q,
+                    imcra_p, l, j, u, IS, sm_win, sm_norm, alpha_s, alpha_d,
+                    Bmin, Gamma0, Gamma1, zeta0, beta, U, V):
+    '''
+    Runs imcra_se.update() for a [K, B, L] STFT Y, or [K, 1, L] if shared by
+    all streams. All state arrays (imcra_se G, Gamma, Lambda_D, p and the
+    imcra buffers and counters) are updated in place. Outputs are written to
+    hat_X and the [K, B, L] st_* arrays. Parameters are given as [B] arrays,
+    except U and V.
+    '''
+
+    K, B, L  = hat_X.shape
+    P        = np.empty(K)
+    Sf       = np.empty(K)
+    I        = np.empty(K)
+    IP       = np.empty(K)
+    norm     = np.empty(K)
+    tilde_Sf = np.empty(K)
+    xi       = np.empty(K)
+    # A shared Y has the same power and frequency smoothing for all streams
+    shared   = Y.shape[1] == 1
+
+    for t in range(L):
+        for b in range(B):
+
+            # Stream of Y used by this configuration
+            bY = min(b, Y.shape[1] - 1)
+            if b == 0 or not shared:
+                for k in range(K):
+                    P[k] = abs(Y[k, bY, t])**2
+                fsmooth(P, sm_win, sm_norm, Sf)
+
+            # DECISION DIRECTED RULE AND MMSE-LSA
+            for k in range(K):
+                # A priori SNR, stationary parameter estimate
+                xi_G        = (G[k, b]**2)*Gamma[k, b]
+                # A posterori SNR
+                Gamma[k, b] = P[k]/Lambda_D[k, b]
+                # A priori SNR, maximum likelihood estimate
+                xi_ML       = Gamma[k, b] - 1
+                if xi_ML < 1e-6:
+                    xi_ML = 1e-6
+                # Decision directed rule with flooring
+                xi[k]       = alpha[b]*xi_G + (1-alpha[b])*xi_ML
+                if xi[k] < xi_min[b]:
+                    xi[k] = xi_min[b]
+                # Wiener gain and MMSE-LSA
+                G[k, b]           = xi[k]/(1 + xi[k])
+                hat_X[k, b, t]    = MMSE_LSA(G[k, b]*Y[k, bY, t],
+                                             G[k, b]*Lambda_D[k, b])
+                st_Lambda_D[k, b, t] = Lambda_D[k, b]
+                st_p[k, b, t]        = p[k, b]
+                st_xi[k, b, t]       = xi[k]
+                st_MSE[k, b, t]      = G[k, b]*Lambda_D[k, b]
+
+            # IMCRA
+            l[b] += 1
+
+            # If in first frame, initialize buffers with observed frame
+            if l[b] == 0:
+                for k in range(K):
+                    S[k, b]              = Sf[k]
+                    tilde_S[k, b]        = Sf[k]
+                    Smin[k, b]           = Sf[k]
+                    tilde_Smin[k, b]     = Sf[k]
+                    Smin_sw[k, b]        = Sf[k]
+                    tilde_Smin_sw[k, b]  = Sf[k]
+                    ov_Lambda_D[k, b]    = P[k]
+                    imcra_Lambda_D[k, b] = P[k]
+                    imcra_p[k, b]        = 1.
+
+            # Frequency and time smoothing, running minimum
+            for k in range(K):
+                S[k, b]       = alpha_s[b]*S[k, b] + (1-alpha_s[b])*Sf[k]
+                Smin[k, b]    = min(Smin[k, b], S[k, b])
+                Smin_sw[k, b] = min(Smin_sw[k, b], S[k, b])
+
+            # Initialization segment, only noise assumed
+            if l[b] < IS[b]:
+                for k in range(K):
+                    q[k, b]              = 1.
+                    imcra_Lambda_D[k, b] = (alpha_d[b]*imcra_Lambda_D[k, b]
+                                            + (1-alpha_d[b])*P[k])
+                    imcra_p[k, b]        = 0.
+
+            else:
+
+                # FIRST MINIMA CONTROLLED VAD
+                for k in range(K):
+                    Gamma_min = P[k]/(Bmin[b]*Smin[k, b])
+                    zeta      = S[k, b]/(Bmin[b]*Smin[k, b])
+                    if Gamma_min < Gamma0[b] and zeta < zeta0[b]:
+                        I[k] = 1.
+                    else:
+                        I[k] = 0.
+                    IP[k] = I[k]*P[k]
+
+                # SECOND MINIMA CONTROLLED VAD
+                fsmooth(I, sm_win, sm_norm, norm)
+                fsmooth(IP, sm_win, sm_norm, tilde_Sf)
+                for k in range(K):
+                    # Bins without any neighbour free of speech keep their
+                    # last value
+                    if norm[k] > 0:
+                        tilde_Sf[k]   = tilde_Sf[k]/norm[k]
+                        tilde_S[k, b] = (alpha_s[b]*tilde_S[k, b]
+                                         + (1-alpha_s[b])*tilde_Sf[k])
+                    tilde_Smin[k, b]    = min(tilde_Smin[k, b], tilde_S[k, b])
+                    tilde_Smin_sw[k, b] = min(tilde_Smin_sw[k, b],
+                                              tilde_S[k, b])
+
+                    # A PRIORI SPEECH ABSENCE
+                    tilde_Gamma_min = P[k]/(Bmin[b]*tilde_Smin[k, b])
+                    tilde_zeta      = S[k, b]/(Bmin[b]*tilde_Smin[k, b])
+                    if tilde_Gamma_min <= 1 and tilde_zeta < zeta0[b]:
+                        q[k, b] = 1.
+                    elif (1 < tilde_Gamma_min and tilde_Gamma_min < Gamma1[b]
+                          and tilde_zeta < zeta0[b]):
+                        q[k, b] = (Gamma1[b] - tilde_Gamma_min)/(Gamma1[b] - 1)
+                    else:
+                        q[k, b] = 0.
+
+                    # A POSTERIORI SPEECH PROBABILITY
+                    if q[k, b] < 1:
+                        nu = Gamma[k, b]*xi[k]/(1 + xi[k])
+                        imcra_p[k, b] = 1./(1 + (q[k, b]/(1 - q[k, b]))
+                                            *(1 + xi[k])*math.exp(-nu))
+                    else:
+                        imcra_p[k, b] = 0.
+
+                    # PROBABILITY DRIVEN RECURSIVE SMOOTHING
+                    tilde_alpha_d        = (alpha_d[b]
+                                            + (1-alpha_d[b])*imcra_p[k, b])
+                    ov_Lambda_D[k, b]    = (tilde_alpha_d*ov_Lambda_D[k, b]
+                                            + (1-tilde_alpha_d)*P[k])
+                    imcra_Lambda_D[k, b] = beta[b]*ov_Lambda_D[k, b]
+
+                # UPDATE MINIMUM TRACKING
+                j[b] += 1
+                if j[b] == V:
+                    slot = u[b] % U
+                    for k in range(K):
+                        Storing[k, slot, b]       = Smin_sw[k, b]
+                        tilde_Storing[k, slot, b] = tilde_Smin_sw[k, b]
+                        Smin[k, b]                = Storing[k, 0, b]
+                        tilde_Smin[k, b]          = tilde_Storing[k, 0, b]
+                        for s in range(1, U):
+                            Smin[k, b]       = min(Smin[k, b],
+                                                   Storing[k, s, b])
+                            tilde_Smin[k, b] = min(tilde_Smin[k, b],
+                                                   tilde_Storing[k, s, b])
+                        Smin_sw[k, b]       = S[k, b]
+                        tilde_Smin_sw[k, b] = tilde_S[k, b]
+                    j[b]  = 0
+                    u[b] += 1
+
+            # Noise estimate and speech probability for the next frame
+            for k in range(K):
+                Lambda_D[k, b] = imcra_Lambda_D[k, b]
+                p[k, b]        = imcra_p[k, b]
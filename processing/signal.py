@@ -71,6 +71,21 @@ def iframing(x_framed, windowsize, shift):
 
     return x
 
+def segments(mask, l0=0):
+    '''
+    Start and end of the runs of True values of a frame mask, e.g. speech
+    regions found by a VAD
+
+    Input: mask      [L] bool ndarray
+    Input: l0        int index of the first frame of mask
+
+    Output: segs     [N, 2] int ndarray, start (included) and end (excluded)
+                     frame of each of the N runs
+    '''
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=int), [0])))
+    return np.array([np.nonzero(edges == 1)[0], 
+                     np.nonzero(edges == -1)[0]]).T + l0
+
 def stft(x, windowsize, shift=None, nfft=None, winfunc='hamming'):
     '''
     Short-time Fourier transform (STFT) of time domain signal 